@@ -46,16 +46,60 @@ CORE_PLUGINS = (
 # MAGFest specific configuration
 # ===========================================================================
 
+# Messages plugins send to each channel, per second, with bursts of up to
+# OUTBOUND_BURST. Replies to commands don't count towards this, so leave room
+# under Slack's limit of about one message per second for them.
+OUTBOUND_RATE = 0.5
+OUTBOUND_BURST = 3
+
 SSH_HOST = os.environ.get('SSH_HOST', 'salt-master.example.com')
 SSH_USERNAME = os.environ.get('SSH_USERNAME', 'root')
 SSH_PASSWORD = os.environ.get('SSH_PASSWORD', '')
 SSH_KEY = os.environ.get('SSH_KEY', '/srv/ssh/magbot_id_rsa')
+SSH_KEEPALIVE = 30
 
 SALT_AUTH = os.environ.get('SALT_AUTH', 'ldap')
 SALT_USERNAME = os.environ.get('SALT_USERNAME', 'username')
 SALT_PASSWORD = os.environ.get('SALT_PASSWORD', 'password')
 SALT_API_URL = os.environ.get('SALT_API_URL', 'https://salt-master.example.com:8000')
 
+# Salt results longer than this are truncated, and optionally uploaded as a file
+SALT_RESULTS_MAX_LENGTH = 3000
+SALT_RESULTS_UPLOAD = True
+
+# Threads used for blocking work, like SSH and Slack uploads, during Salt commands
+SALT_BLOCKING_THREADS = 2
+
+# Salt command timings are written here in the Prometheus text format, if set
+SALT_METRICS_FILE = None
+
+# Number of recent Salt jobs kept for the salt slowest command
+SALT_JOB_STATS_HISTORY = 50
+
+# Seconds between refreshes of the cached minion ids and grains, 0 to disable
+SALT_MINION_CACHE_INTERVAL = 300
+
+# Seconds between polls for the results of Salt jobs, if set, instead of each
+# command's own interval. Jobs still time out after the same amount of time.
+SALT_POLL_INTERVAL = None
+
+# Seconds before a links trigger phrase replies again in the same channel
+LINKS_COOLDOWN = 60
+
+
+# ===========================================================================
+# Uncomment to use SQLite for storage backend
+#
+# Keeps each plugin's data in its own database, in WAL mode, with indexes
+# for case insensitive, prefix and link lookups.
+# ===========================================================================
+#
+# BOT_EXTRA_STORAGE_PLUGINS_DIR = '/srv/plugins/magbot/storage'
+# STORAGE = 'SQLite'
+# STORAGE_CONFIG = {
+#     'basedir': '/srv/data',
+# }
+
 
 # ===========================================================================
 # Uncomment to use Redis for storage backend
@@ -1,6 +1,8 @@
 import requests
 from errbot import BotPlugin, botcmd
 
+from magbot import MagbotMixin
+
 
 def _normalize_url(url):
     url = (url or '').strip()
@@ -41,7 +43,7 @@ def _get_event_color(sold_pct):
         return 'red'
 
 
-class Badges(BotPlugin):
+class Badges(MagbotMixin, BotPlugin):
 
     @botcmd
     def badges(self, mess, args):
@@ -0,0 +1,120 @@
+import cProfile
+import inspect
+import marshal
+import os
+import pstats
+import tempfile
+import time
+
+from errbot import BotPlugin, botcmd
+
+from magbot import IMPORT_TIMES, STARTUP_TIMES, MagbotMixin, capture_sends
+
+
+class Diagnostics(MagbotMixin, BotPlugin):
+
+    PROFILE_TOP = 15
+
+    def _find_command(self, text):
+        """
+        Finds the command that text would run, the same way errbot does.
+
+        Returns a tuple of the command name, its method, and the args or
+        regex match it should be called with.
+        """
+        words = text.split()
+        for i in range(len(words), 0, -1):
+            name = '_'.join(words[:i])
+            method = self._bot.commands.get(name)
+            if method:
+                return (name, method, text.split(maxsplit=i)[-1] if len(words) > i else '')
+
+        for name, method in list(self._bot.re_commands.items()):
+            match = method._err_command_re_pattern.search(text)
+            if match:
+                return (name, method, match)
+        return (None, None, None)
+
+    @staticmethod
+    def _format_stats(stats, limit):
+        lines = ['{:>9} {:>9} {:>9}  {}'.format('calls', 'tottime', 'cumtime', 'function')]
+        rows = sorted(stats.stats.items(), key=lambda i: i[1][3], reverse=True)
+        for (filename, line, func), (_, calls, tottime, cumtime, _) in rows[:limit]:
+            location = '{}:{}'.format(os.path.basename(filename), line) if line else filename
+            lines.append('{:>9} {:>8.3f}s {:>8.3f}s  {} ({})'.format(calls, tottime, cumtime, func, location))
+        return '\n'.join(lines)
+
+    @botcmd
+    def startup_times(self, msg, args):
+        """Show how long each magbot plugin took to activate, and what it imported on first use"""
+        if not STARTUP_TIMES:
+            return "I haven't timed any plugins yet"
+
+        lines = ['{:<32} {:>9}'.format('plugin', 'activate')]
+        for name, seconds in sorted(STARTUP_TIMES.items(), key=lambda i: i[1], reverse=True):
+            lines.append('{:<32} {:>8.3f}s'.format(name, seconds))
+        lines.append('{:<32} {:>8.3f}s'.format('total', sum(STARTUP_TIMES.values())))
+
+        if IMPORT_TIMES:
+            lines.extend(['', '{:<32} {:>9}  {}'.format('lazy import', 'seconds', 'first used by')])
+            for name, (seconds, plugin) in sorted(IMPORT_TIMES.items(), key=lambda i: i[1][0], reverse=True):
+                lines.append('{:<32} {:>8.3f}s  {}'.format(name, seconds, plugin or '-'))
+        return '```\n{}\n```'.format('\n'.join(lines))
+
+    @botcmd(admin_only=True)
+    def profile(self, msg, args):
+        """Profile a command, and attach the full profile: profile <command ...>
+
+        The messages the command sends are counted instead of sent. Work the
+        command hands off to other threads, like Salt jobs, isn't profiled.
+        """
+        text = args.strip()
+        if text.startswith(self._bot.prefix):
+            text = text[len(self._bot.prefix):].strip()
+        if not text:
+            yield 'Usage: `{}profile <command ...>`'.format(self._bot.prefix)
+            return
+
+        name, method, command_args = self._find_command(text)
+        if not method:
+            yield "I don't know the command `{}`".format(text)
+            return
+        elif name == 'profile':
+            yield "I can't profile the profile command"
+            return
+
+        error = None
+        profiler = cProfile.Profile()
+        with capture_sends() as sends:
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                replies = method(msg, command_args)
+                replies = list(replies) if inspect.isgenerator(replies) else [replies]
+            except Exception as ex:
+                replies = []
+                error = ex
+            finally:
+                profiler.disable()
+            elapsed = time.perf_counter() - started
+
+        stats = pstats.Stats(profiler)
+        replies = [r for r in replies if r]
+        summary = '**Profiled** `{}` in {:.3f}s: {} repl{}, {} message{} sent'.format(
+            name.replace('_', ' '),
+            elapsed,
+            len(replies),
+            'y' if len(replies) == 1 else 'ies',
+            len(sends),
+            '' if len(sends) == 1 else 's')
+        if error:
+            summary += ', failed with `{}`'.format(error)
+        yield '{}\n```\n{}\n```'.format(summary, self._format_stats(stats, self.PROFILE_TOP))
+
+        output = tempfile.TemporaryFile()
+        marshal.dump(stats.stats, output)
+        size = output.tell()
+        output.seek(0)
+        self.send_stream_request(
+            self.message_identifier(msg), output, name='{}.prof'.format(name), size=size,
+            stream_type='application/octet-stream')
@@ -1,5 +1,9 @@
-from errbot import BotPlugin
-from magbot import FabricMixin, MagbotMixin, SaltMixin
+import asyncio
+
+from errbot import BotPlugin, botcmd
+from magbot import MagbotMixin
+from magbot_fabric import FabricMixin
+from magbot_salt import SaltMixin, current_task
 
 
 ENVS = ['prod', 'staging', 'load', 'dev', 'onsite']
@@ -21,39 +25,127 @@ class Infrastructure(MagbotMixin, FabricMixin, SaltMixin, BotPlugin):
     Infrastructure automation utilities.
     """
 
+    def __init__(self, *args, **kwargs):
+        self._infrastructure_commit = None
+        self._infrastructure_sync = None
+        super().__init__(*args, **kwargs)
+
+    def deactivate(self):
+        # The sync is bound to the Salt event loop, which is replaced on the next activation
+        sync = self._infrastructure_sync
+        if sync is not None and self._salt_loop:
+            self._salt_loop.loop.call_soon_threadsafe(sync.cancel)
+        self._infrastructure_sync = None
+        super().deactivate()
+
     def _update_infrastructure_repo(self):
+        """
+        Pull the infrastructure repo and refresh the salt fileserver.
+
+        The fileserver is only refreshed if the pull changed the checked out
+        commit. Returns the checked out commit.
+        """
         with self.FabricConnection() as c:
             c.sudo('git -C /srv/infrastructure pull')
-            c.sudo('salt-run fileserver.update')
+            commit = c.sudo('git -C /srv/infrastructure rev-parse HEAD', hide=True).stdout.strip()
+            if commit != self._infrastructure_commit:
+                c.sudo('salt-run fileserver.update')
+                self._infrastructure_commit = commit
+            else:
+                self.log.debug('Infrastructure repo unchanged at {}'.format(commit))
+        return commit
+
+    async def _sync_infrastructure_repo(self):
+        """
+        Run _update_infrastructure_repo() without blocking the Salt event loop.
+
+        Concurrent callers await the sync that's already in flight, rather
+        than starting their own, so only one blocking thread is ever used.
+        """
+        if self._infrastructure_sync is None:
+            self._infrastructure_sync = asyncio.ensure_future(self._run_infrastructure_sync())
+        with self.perf_span('repo_sync'):
+            return await asyncio.shield(self._infrastructure_sync)
 
-    @SaltMixin.async_cmd('Deploying latest reggie to {args}... (takes a few minutes)', **reggie_target_args)
-    def deploy(self, msg, args, targets):
-        """Deploy reggie to target servers"""
-        self._update_infrastructure_repo()
-        yield self.salt_api.local_async(targets, 'state.apply', expr_form='compound')
+    async def _run_infrastructure_sync(self):
+        try:
+            return await self.run_blocking(self._update_infrastructure_repo)
+        finally:
+            # Unless it was already dropped by deactivate()
+            if self._infrastructure_sync is current_task():
+                self._infrastructure_sync = None
+
+    @SaltMixin.async_cmd(
+        'Deploying latest reggie to {args}... (takes a few minutes)',
+        batch=True,
+        prepare=_sync_infrastructure_repo,
+        **reggie_target_args)
+    async def deploy(self, msg, args, targets):
+        """Deploy reggie to target servers, use --batch 25% to deploy in waves"""
+        return await self.salt_api.local_async(targets, 'state.apply', expr_form='compound')
 
     @SaltMixin.cmd(**reggie_target_args)
-    def ip_addrs(self, msg, args, targets):
+    async def ip_addrs(self, msg, args, targets):
         """List ip addresses of target reggie servers"""
-        results = self.salt_api.local(targets, 'network.ip_addrs', expr_form='compound')
+        results = await self.salt_api.local(targets, 'network.ip_addrs', expr_form='compound')
         for servers in results.get('return', []):
             for server, ip_addrs in servers.items():
                 ip_addrs[:] = [s for s in ip_addrs if not s.startswith('10.10.')]
-        yield results
+        return results
 
     @SaltMixin.cmd(**reggie_target_args)
-    def ping(self, msg, args, targets):
+    async def ping(self, msg, args, targets):
         """Ping target reggie servers"""
-        yield self.salt_api.local(targets, 'test.ping', expr_form='compound')
+        return await self.salt_api.local(targets, 'test.ping', expr_form='compound')
+
+    @botcmd
+    @SaltMixin.parse_target_args(**reggie_target_args)
+    def targets(self, msg, args, targets):
+        """Preview the reggie servers matched by target args"""
+        cache = self._fresh_minion_cache()
+        minions = cache.resolve(targets) if cache else None
+        if cache is None:
+            yield "I can't preview `{}` until the minion cache is loaded".format(targets)
+        elif minions is None:
+            yield "I can't preview `{}` without the salt master, but commands will still target it".format(targets)
+        else:
+            yield '**Target**: `{}` \n **Matches {} server{}**: \n {}'.format(
+                targets,
+                len(minions),
+                '' if len(minions) == 1 else 's',
+                self._format_results(sorted(minions), unwrap_singular_list=False))
+
+    @botcmd
+    def salt_perf(self, msg, args):
+        """Show how long each phase of salt commands takes, or the timeline of a job"""
+        jid = args.strip()
+        report = self.perf.report(jid)
+        if report is None:
+            return "I don't have a timeline for job `{}`".format(jid)
+        return '```\n{}\n```'.format(report)
+
+    @botcmd
+    def salt_slowest(self, msg, args):
+        """Rank the slowest servers and states across recent deploys, optionally for one env"""
+        env = args.strip() or None
+        minions, states = self.job_stats.slowest(env)
+        if not minions:
+            return "I haven't tracked any {}jobs yet".format(env + ' ' if env else '')
+
+        lines = ['{:<40} {:>8} {:>8} {:>5} {:>8}'.format('server (seconds to return)', 'p50', 'p95', 'jobs', 'no resp')]
+        lines.extend('{:<40} {:>8.1f} {:>8.1f} {:>5} {:>8}'.format(*r) for r in minions)
+        lines.extend(['', '{:<40} {:>8} {:>8} {:>5}'.format('state (ms)', 'p50', 'p95', 'jobs')])
+        lines.extend('{:<40} {:>8} {:>8} {:>5}'.format(*r[:4]) for r in states)
+        _, interval, _ = self._async_cmd_schedule('deploy')
+        return '```\n{}\n```\nReturn times are only as precise as the {}s poll interval. Servers that ' \
+            'never responded count as the time the job waited for them.'.format('\n'.join(lines), interval)
 
-    @SaltMixin.async_cmd('Updating magbot... (takes a few minutes)')
-    def update_magbot(self, msg, args, targets):
+    @SaltMixin.async_cmd('Updating magbot... (takes a few minutes)', prepare=_sync_infrastructure_repo)
+    async def update_magbot(self, msg, args, targets):
         """Update magbot"""
-        self._update_infrastructure_repo()
-        yield self.salt_api.local_async('mcp.magfest.net', 'state.sls', 'docker_magbot')
+        return await self.salt_api.local_async('mcp.magfest.net', 'state.sls', 'docker_magbot')
 
-    @SaltMixin.async_cmd('Updating mcp... (takes a few minutes)')
-    def update_mcp(self, msg, args, targets):
+    @SaltMixin.async_cmd('Updating mcp... (takes a few minutes)', prepare=_sync_infrastructure_repo)
+    async def update_mcp(self, msg, args, targets):
         """Update mcp"""
-        self._update_infrastructure_repo()
-        yield self.salt_api.local_async('mcp.magfest.net', 'state.apply')
+        return await self.salt_api.local_async('mcp.magfest.net', 'state.apply')
@@ -1,5 +1,8 @@
 import random
 import re
+import threading
+import time
+from collections import OrderedDict
 from functools import reduce
 
 from errbot import BotPlugin, botcmd
@@ -71,9 +74,26 @@ class LinkTrigger(object):
     def random_link(self):
         return random.choice(self.links) if self.links else None
 
+    def index_terms(self):
+        return {'url': set(self.links)}
+
 
 class Links(MagbotMixin, BotPlugin):
 
+    MATCH_CACHE_SIZE = 1000
+
+    def __init__(self, *args, **kwargs):
+        self.cooldown = 60
+        self._cooldowns = {}
+        self._matches = OrderedDict()
+        self._matches_generation = 0
+        self._lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def activate(self):
+        self.cooldown = getattr(self.bot_config, 'LINKS_COOLDOWN', self.cooldown)
+        super().activate()
+
     @staticmethod
     def _bullet_list(items):
         if items:
@@ -93,6 +113,47 @@ class Links(MagbotMixin, BotPlugin):
                 return (key, link_trigger)
         return (None, None)
 
+    def _match_link_trigger(self, text):
+        """
+        Like _find_link_trigger(), but remembers the results for the most
+        recently seen message texts, until a trigger is added or removed.
+        """
+        with self._lock:
+            if text in self._matches:
+                self._matches.move_to_end(text)
+                return self._matches[text]
+            generation = self._matches_generation
+
+        match = self._find_link_trigger(text)
+        with self._lock:
+            if generation == self._matches_generation:
+                self._matches[text] = match
+                if len(self._matches) > self.MATCH_CACHE_SIZE:
+                    self._matches.popitem(last=False)
+        return match
+
+    def _clear_matches(self):
+        with self._lock:
+            self._matches.clear()
+            self._matches_generation += 1
+
+    def _start_cooldown(self, key, channel):
+        """
+        Returns False if the trigger already replied in the channel within
+        the cooldown, otherwise starts a new cooldown and returns True.
+        """
+        if not self.cooldown:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            replied = self._cooldowns.get((key, channel))
+            if replied is not None and now - replied < self.cooldown:
+                return False
+            if len(self._cooldowns) >= self.MATCH_CACHE_SIZE:
+                self._cooldowns = {k: t for k, t in self._cooldowns.items() if now - t < self.cooldown}
+            self._cooldowns[(key, channel)] = now
+        return True
+
     def _add_link_trigger(self, trigger_pattern, links):
         key, link_trigger = self._find_link_trigger(trigger_pattern, fullmatch=True)
         if not link_trigger:
@@ -103,6 +164,7 @@ class Links(MagbotMixin, BotPlugin):
 
         link_trigger.add_links(links)
         self[key] = link_trigger
+        self._clear_matches()
 
         return link_trigger
 
@@ -110,11 +172,13 @@ class Links(MagbotMixin, BotPlugin):
         key, link_trigger = self._find_link_trigger(query, fullmatch=True)
         if link_trigger:
             del self[key]
+            self._clear_matches()
             return [link_trigger]
 
         removed = []
         link = query.strip()
-        for key, link_trigger in list(self.items()):
+        for key in self.storage_keys_for_term('url', link):
+            link_trigger = self[key]
             removed_link = link_trigger.remove_link(link)
             if removed_link:
                 if link_trigger.links:
@@ -122,6 +186,8 @@ class Links(MagbotMixin, BotPlugin):
                 else:
                     del self[key]
                 removed.append(LinkTrigger(key, [removed_link]))
+        if removed:
+            self._clear_matches()
         return removed
 
     def callback_message(self, msg):
@@ -141,11 +207,12 @@ class Links(MagbotMixin, BotPlugin):
                 # This is a links command in a direct message, ignore it
                 return
 
-        key, link_trigger = self._find_link_trigger(msg.body)
+        key, link_trigger = self._match_link_trigger(msg.body)
         if link_trigger:
             link = link_trigger.random_link()
-            if link:
-                self.send(self.message_identifier(msg), link)
+            identifier = self.message_identifier(msg)
+            if link and self._start_cooldown(key, str(identifier)):
+                self.send(identifier, link)
 
     @botcmd
     def links(self, msg, args):
@@ -1,15 +1,47 @@
+import importlib
 import inspect
-from collections import Mapping, OrderedDict
-from datetime import datetime
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from functools import wraps
+from itertools import count
 
-import pepper
-import yaml
-from errbot import botcmd
-from fabric.connection import Connection
-from fabric.config import Config
-from pepper.libpepper import PepperException
-from pockets import is_listy
+from errbot.backends.base import Identifier
+
+
+log = logging.getLogger('errbot.plugins.magbot')
+
+
+# Seconds spent in each magbot plugin's activate(), by plugin name. Other
+# plugins, like Archive and errbot's core plugins, aren't timed, since that
+# would mean patching errbot internals that change between versions.
+STARTUP_TIMES = OrderedDict()
+
+# Seconds spent importing each lazily imported module, and the plugin that
+# was activating when it was first used, by module name
+IMPORT_TIMES = OrderedDict()
+
+_activating = threading.local()
+
+_captured = threading.local()
+
+
+def lazy_import(name):
+    """
+    Import a module the first time it's used, and record how long it took.
+
+    Heavy optional dependencies are imported with this inside the functions
+    that need them, so plugins that never use them don't pay for them.
+    """
+    module = sys.modules.get(name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        IMPORT_TIMES[name] = (time.perf_counter() - started, getattr(_activating, 'plugin', None))
+    return module
 
 
 def gen(func):
@@ -44,386 +76,288 @@ def monkeypatch(Class, method_name):
     return decorator
 
 
-@monkeypatch(Connection, 'run')
-def _Connection_run(self, original_method, *args, **kwargs):
-    kwargs['in_stream'] = False
-    return original_method(self, *args, **kwargs)
+@contextmanager
+def capture_sends():
+    """
+    Collects the messages and cards that magbot plugins send from this
+    thread, instead of sending them. Yields the list they're collected in.
+    """
+    previous = getattr(_captured, 'sends', None)
+    _captured.sends = []
+    try:
+        yield _captured.sends
+    finally:
+        _captured.sends = previous
+
+
+class _Outbound(object):
+    __slots__ = ('priority', 'sequence', 'send', 'text', 'kwargs', 'on_sent')
+
+    def __init__(self, priority, sequence, send, text=None, on_sent=None, **kwargs):
+        self.priority = priority
+        self.sequence = sequence
+        self.send = send
+        self.text = text
+        self.kwargs = kwargs
+        self.on_sent = [(time.monotonic(), on_sent)] if on_sent else []
+
+    def merge(self, other, max_length):
+        """
+        Appends the text of other to this message, if they're both small
+        texts headed to the same place. Returns True if they were merged.
+        """
+        if self.text is None or other.text is None or self.kwargs != other.kwargs:
+            return False
+        if len(self.text) + len(other.text) + 3 > max_length:
+            return False
+        self.text = '{} \n {}'.format(self.text, other.text)
+        self.on_sent.extend(other.on_sent)
+        return True
+
+    def deliver(self):
+        if self.text is None:
+            self.send(**self.kwargs)
+        else:
+            self.send(text=self.text, **self.kwargs)
 
+    def sent(self, started, delivering, duration):
+        """
+        Calls the on_sent callbacks of the message, and of every message
+        merged into it, with the time.time() its delivery started, the
+        seconds it waited in the queue, and the seconds delivery took.
+        """
+        for queued, on_sent in self.on_sent:
+            try:
+                on_sent(started, delivering - queued, duration)
+            except Exception:
+                log.exception('Failed to record sent message')
 
-@monkeypatch(Connection, 'sudo')
-def _Connection_sudo(self, original_method, *args, **kwargs):
-    kwargs['in_stream'] = False
-    return original_method(self, *args, **kwargs)
 
+class _OutboundChannel(object):
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.updated = time.monotonic()
+        self.queues = (deque(), deque())
 
-class MagbotMixin(object):
-    """
-    Common magbot utilities.
-    """
+    def refill(self, now, rate, burst):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
 
-    DIVERT_TO_THREAD = ()
+    def peek(self):
+        for priority, queue in enumerate(self.queues):
+            if queue:
+                return (priority, queue[0].sequence)
+        return None
 
-    def activate(self):
-        self.bot_config.DIVERT_TO_THREAD = self.bot_config.DIVERT_TO_THREAD + self.DIVERT_TO_THREAD
-        super().activate()
 
-    def message_identifier(self, msg):
-        return getattr(msg.frm, 'room', msg.frm)
+class OutboundQueue(object):
+    """
+    Sends the messages of every magbot plugin from a single thread.
 
+    Each channel gets a token bucket of burst messages, refilled at rate
+    messages per second, to stay under Slack's per-channel rate limits.
+    Replies are sent before background notifications, and consecutive small
+    texts to the same channel and thread are merged into a single message.
 
-class FabricMixin(object):
-    """
-    Fabric automation utilities.
-    """
+    Only the messages plugins send themselves go through the queue. The
+    replies that commands return or yield are sent by errbot directly, so
+    they don't take tokens from the bucket, and aren't ordered against
+    queued messages. The default rate is half of Slack's limit of about one
+    message per second to leave room for them.
 
-    def activate(self):
-        self.fabric_connection_kwargs = {
-            'host': self.bot_config.SSH_HOST,
-            'user': self.bot_config.SSH_USERNAME,
-            'config': Config({
-                'sudo': {
-                    'username': self.bot_config.SSH_USERNAME,
-                    'password': self.bot_config.SSH_PASSWORD,
-                },
-            }),
-            'connect_kwargs': {
-                'key_filename': self.bot_config.SSH_KEY,
-            },
-        }
-        super().activate()
-
-    def FabricConnection(self):
-        return Connection(**self.fabric_connection_kwargs)
-
-
-class PollerMixin(object):
-    """
-    Polling utilities.
+    The token buckets are the only protection against rate limits. Messages
+    that are rate limited anyway aren't retried, since backends like
+    slackv3 log and swallow the error before it reaches the queue.
+
+    Messages can be put with an on_sent callback, to time how long they
+    waited and how long they took to send, see _Outbound.sent().
     """
 
-    def program_next_poll(self, interval, method, times, args, kwargs):
+    REPLY = 0
+    BACKGROUND = 1
+
+    def __init__(self, rate=0.5, burst=3, merge_length=1000):
+        self.rate = rate
+        self.burst = burst
+        self.merge_length = merge_length
+        self._channels = {}
+        self._sequence = count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def put(self, channel, priority, send, text=None, on_sent=None, **kwargs):
+        with self._condition:
+            if channel not in self._channels:
+                self._channels[channel] = _OutboundChannel(self.burst)
+            outbound = _Outbound(priority, next(self._sequence), send, text, on_sent, **kwargs)
+            self._channels[channel].queues[priority].append(outbound)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='Magbot outbound queue', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _next(self):
         """
-        If the poll function is called "times" times, a timeout method will
-        be called with the same arguments. The timeout method should be
-        declared on the class, and have the same name as the poll function
-        with "_timeout" appended.
+        Pops the next message that's allowed to be sent.
+
+        If no message can be sent yet, returns the number of seconds to wait
+        until one can, or None if the queue is empty.
+
+        Channels with nothing queued and a full bucket are dropped, they're
+        added back with a full bucket when a message is next put.
         """
-        if times is not None and times <= 0:
-            timeout_method = getattr(self, '{}_timeout'.format(method.__name__), None)
-            if timeout_method:
-                timeout_method(*args, **kwargs)
-        super().program_next_poll(interval, method, times, args, kwargs)
+        now = time.monotonic()
+        ready, wait = None, None
+        for name, channel in list(self._channels.items()):
+            head = channel.peek()
+            channel.refill(now, self.rate, self.burst)
+            if head is None:
+                if channel.tokens >= self.burst:
+                    del self._channels[name]
+                continue
+            if channel.tokens >= 1:
+                if ready is None or head < ready[0]:
+                    ready = (head, channel)
+            else:
+                seconds = (1 - channel.tokens) / self.rate
+                wait = seconds if wait is None else min(wait, seconds)
+
+        if ready is None:
+            return (None, wait)
+
+        (priority, _), channel = ready
+        channel.tokens -= 1
+        queue = channel.queues[priority]
+        outbound = queue.popleft()
+        while queue and outbound.merge(queue[0], self.merge_length):
+            queue.popleft()
+        return (outbound, 0)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                outbound, wait = self._next()
+                while outbound is None:
+                    self._condition.wait(wait)
+                    outbound, wait = self._next()
+
+            started = time.time()
+            delivering = time.monotonic()
+            try:
+                outbound.deliver()
+                outbound.sent(started, delivering, time.monotonic() - delivering)
+            except Exception:
+                log.exception('Failed to send message')
 
 
-class SaltMixin(PollerMixin):
+# Shared by every plugin, so they all draw from the same per-channel limits
+outbound_queue = OutboundQueue()
+
+
+class MagbotMixin(object):
     """
-    Salt API utilities.
+    Common magbot utilities.
     """
 
-    @staticmethod
-    def _validate_grain_args(grains, grain_args):
-        for grain_arg in grain_args:
-            name = grain_arg['name']
-            value = grains.get(name)
-            if value:
-                if value in grain_arg.get('ignore', []):
-                    return True
-                choices = grain_arg.get('choices', [])
-                if choices and value not in choices:
-                    return 'unknown {}: \`{}\`, valid values: {}'.format(name, value, ', '.join(choices))
-                value_type = grain_arg.get('type', str)
-                try:
-                    value_type(value)
-                except Exception:
-                    return 'invalid {}: \`{}\`'.format(name, value)
-            elif grain_arg.get('required'):
-                return '{} is required'.format(name)
-        return None
+    DIVERT_TO_THREAD = ()
 
-    @staticmethod
-    def parse_target_args(default_targets=None, grain_args=[]):
-        """
-        Decorator to parse salt targets from command args.
+    def activate(self):
+        started = time.perf_counter()
+        _activating.plugin = self.name
+        try:
+            self.bot_config.DIVERT_TO_THREAD = self.bot_config.DIVERT_TO_THREAD + self.DIVERT_TO_THREAD
+            outbound_queue.rate = getattr(self.bot_config, 'OUTBOUND_RATE', outbound_queue.rate)
+            outbound_queue.burst = getattr(self.bot_config, 'OUTBOUND_BURST', outbound_queue.burst)
+            super().activate()
+        finally:
+            _activating.plugin = None
+            STARTUP_TIMES[self.name] = time.perf_counter() - started
+
+    def message_identifier(self, msg):
+        return getattr(msg.frm, 'room', msg.frm)
+
+    def send(self, identifier, text, in_reply_to=None, groupchat_nick_reply=False, background=False, on_sent=None):
         """
-        grain_args_usage = ' '.join(
-            [g['name'] if g.get('required') else '[{}]'.format(g['name']) for g in grain_args] + ['[roles:(web|db)]'])
-
-        def decorator(func):
-            @wraps(func)
-            def with_parse_target_args(self, msg, args):
-                args = args.split()
-                grain_names = [g['name'] for g in reversed(grain_args)]
-                grains = OrderedDict()
-                regex_grains = []
-                extra_targets = []
-                for arg in args:
-                    if '@' in arg:
-                        extra_targets.append(arg)
-                    elif ':' in arg:
-                        regex_grains.append(arg)
-                    elif grain_names:
-                        grains[grain_names.pop()] = arg
-                    else:
-                        extra_targets.append(arg)
-
-                error = SaltMixin._validate_grain_args(grains, grain_args)
-                if error is True:
-                    yield None  # We hit a value that should be ignored
-                elif error:
-                    yield 'Parse error: {} \n ' \
-                        'Usage: \`{}{} {}\`'.format(error, self._bot.prefix, func.__name__, grain_args_usage)
-                else:
-                    targets = [default_targets] if default_targets else []
-                    for grain, value in grains.items():
-                        targets.append('G@{}:{}'.format(grain, value))
-                    for regex_grain in regex_grains:
-                        targets.append('P@{}'.format(regex_grain))
-                    for extra_target in extra_targets:
-                        targets.append(extra_target)
-                    targets = ' and '.join(targets)
-
-                    yield from gen(func)(self, msg, args, targets)
-
-            return with_parse_target_args
-
-        if callable(default_targets):
-            func = default_targets
-            default_targets = None
-            return decorator(func)
-        else:
-            return decorator
+        Queues a message to a room or a user.
 
-    @staticmethod
-    def api_auth(func):
+        Background messages, like job notifications, wait until every reply
+        queued for the same channel has been sent. If set, on_sent is called
+        once the message is sent, see OutboundQueue.
         """
-        Decorator to authenticate against the Salt API before calling the function.
+        if not isinstance(identifier, Identifier):
+            raise ValueError('identifier needs to be of type Identifier, the old string behavior is not supported')
+        if getattr(_captured, 'sends', None) is not None:
+            _captured.sends.append(text)
+            return
+        outbound_queue.put(
+            str(getattr(identifier, 'room', identifier)),
+            OutboundQueue.BACKGROUND if background else OutboundQueue.REPLY,
+            super().send,
+            text,
+            on_sent,
+            identifier=identifier,
+            in_reply_to=in_reply_to,
+            groupchat_nick_reply=groupchat_nick_reply)
+
+    def send_card(self, background=False, on_sent=None, **kwargs):
         """
-        @wraps(func)
-        def with_api_auth(self, *args, **kwargs):
-            old_token = self._cached_api_auth.get('token')
-            self._renew_api_auth()
-            new_token = self._cached_api_auth.get('token')
-            try:
-                yield from gen(func)(self, *args, **kwargs)
-            except PepperException as error:
-                if old_token == new_token and 'authentication denied' in str(error).lower():
-                    self.log.debug('Cached Salt API token failed, attempting to update')
-                    self._cached_api_auth = {}
-                    self._renew_api_auth()
-                    yield from gen(func)(self, *args, **kwargs)
-                else:
-                    raise error
-
-        return with_api_auth
-
-    @staticmethod
-    def cmd(salutation=None, default_targets=None, grain_args=[]):
+        Queues a card, see send() for how background cards are sent.
         """
-        Decorator to format results from the Salt API.
+        to = kwargs.get('to')
+        if to is None:
+            if kwargs.get('in_reply_to') is None:
+                raise ValueError('Either to or in_reply_to needs to be set.')
+            to = kwargs['in_reply_to'].frm
+        if getattr(_captured, 'sends', None) is not None:
+            _captured.sends.append(kwargs)
+            return
+        outbound_queue.put(
+            str(getattr(to, 'room', to)),
+            OutboundQueue.BACKGROUND if background else OutboundQueue.REPLY,
+            super().send_card,
+            on_sent=on_sent,
+            **kwargs)
+
+    # The storage_* methods use the indexed queries of the SQLite storage
+    # plugin when it's configured, and fall back to scanning every key with
+    # any other errbot storage.
+
+    def storage_get_lower(self, key):
         """
-        def decorator(func):
-            @botcmd
-            @wraps(func)
-            @SaltMixin.parse_target_args(default_targets, grain_args)
-            def with_salt_cmd(self, msg, args, targets):
-                if salutation:
-                    yield salutation.format(args=' '.join(args))
-
-                for results in SaltMixin.api_auth(func)(self, msg, args, targets):
-                    yield self._format_results(results)
-
-            return with_salt_cmd
-
-        if callable(salutation):
-            func = salutation
-            salutation = None
-            return decorator(func)
-        else:
-            return decorator
+        Returns the value of key, matched case insensitively.
 
-    @staticmethod
-    def async_cmd(salutation=None, default_targets=None, grain_args=[], interval=20, times=9):
+        Without the SQLite storage, this only finds keys that were stored in
+        lowercase.
         """
-        Decorator to poll for asynchronous results from the Salt API.
-        """
-        def decorator(func):
-            @botcmd
-            @wraps(func)
-            @SaltMixin.parse_target_args(default_targets, grain_args)
-            def with_salt_async_cmd(self, msg, args, targets):
-                if salutation:
-                    yield salutation.format(args=' '.join(args))
-
-                for async_results in SaltMixin.api_auth(func)(self, msg, args, targets):
-                    results = async_results['return'][0]
-                    jid = results.get('jid', None)
-                    minions = results.get('minions', [])
-                    yield self._format_async_results(args, jid, minions)
-
-                    if jid:
-                        self._current_jobs[jid] = {'minion_results': {}}
-                        self.start_poller(
-                            interval,
-                            self.async_cmd_poller,
-                            times=times,
-                            args=[jid, minions, msg, args],
-                            kwargs={'targets': targets})
-
-            return with_salt_async_cmd
-
-        if callable(salutation):
-            func = salutation
-            salutation = None
-            return decorator(func)
-        else:
-            return decorator
+        if hasattr(self._store, 'get_lower'):
+            return self._store.get_lower(key)
+        return self[key.lower()]
 
-    def __init__(self, *args, **kwargs):
-        self.salt_api = None
-        self._cached_api_auth = {}
-        self._current_jobs = {}
-        super().__init__(*args, **kwargs)
-
-    def activate(self):
-        try:
-            self.salt_api = pepper.Pepper(self.bot_config.SALT_API_URL)
-            self.log.debug('Salt API: {}'.format(self.bot_config.SALT_API_URL))
-        except Exception:
-            self.log.error('Failed to initialize Salt API: {}'.format(self.bot_config.SALT_API_URL), exc_info=True)
-            raise
-        super().activate()
-
-    def _format_async_results(self, args, jid, minions):
-        if jid:
-            message = ['**Started job**: {}/molten/job/{}'.format(self.bot_config.SALT_API_URL, jid)]
-            if len(minions) == 1:
-                message.append('**Target server**: {}'.format(minions[0]))
-            elif minions:
-                message.append('**Target servers**: \n {}'.format(self._format_results(sorted(minions))))
-            return ' \n '.join(message)
-        return 'No job started, no servers found for {}'.format(' '.join(args))
-
-    def _format_failure_state(self, state):
-        results = []
-        if state.get('__id__'):
-            results.append('*ID*: {__id__}'.format(**state))
-        elif state.get('name'):
-            results.append('*Name*: {name}'.format(**state))
-        if state.get('__sls__'):
-            results.append('*SLS*: {__sls__}'.format(**state))
-        if state.get('comment'):
-            results.append('*Comment*: {comment}'.format(**state))
-        results.append('*Changes*: \n```\n{}```'.format(yaml.dump(state.get('changes', {}), default_flow_style=False)))
-        return ' \n '.join(results)
-
-    def _format_results(self, results, unwrap_singular_list=True):
-        if isinstance(results, Mapping):
-            if results.get('return'):
-                results = results['return']
-
-        while unwrap_singular_list and is_listy(results) and len(results) == 1:
-            results = results[0]
-
-        return yaml.dump(results, default_flow_style=False)
-
-    def _renew_api_auth(self):
+    def storage_keys_with_prefix(self, prefix, limit=-1, offset=0):
         """
-        The Salt API returns an auth dictionary that looks like this::
-
-            self._cached_api_auth = {
-                'user': 'username',
-                'perms': [{'*': ['.*']}],
-                'eauth': 'ldap',
-                'start': 1535780898.745305,
-                'expire': 1535824098.745305,
-                'token': 'XXXXXXXXXXXXX',
-            }
+        Returns the sorted keys starting with prefix.
         """
-        if self._cached_api_auth.get('expire'):
-            expiration = datetime.fromtimestamp(self._cached_api_auth['expire'])
-            seconds_to_expiration = (expiration - datetime.utcnow()).total_seconds()
-            if seconds_to_expiration > 900:
-                # The auth token won't expire for at least 15 minutes
-                self.log.debug('Using cached Salt API auth token')
-                return
+        if hasattr(self._store, 'keys_with_prefix'):
+            return self._store.keys_with_prefix(prefix, limit, offset)
+        keys = sorted(key for key in self.keys() if key.startswith(prefix))[offset:]
+        return keys if limit < 0 else keys[:limit]
 
-        try:
-            self._cached_api_auth = self.salt_api.login(
-                self.bot_config.SALT_USERNAME, self.bot_config.SALT_PASSWORD, self.bot_config.SALT_AUTH)
-            self.log.debug('Updated cached Salt API auth token')
-        except Exception:
-            self.log.error('Failed to authenticate against Salt API: user="{}", auth="{}"'.format(
-                self.bot_config.SALT_USERNAME, self.bot_config.SALT_AUTH), exc_info=True)
-            raise
-
-    def async_cmd_poller(self, jid, minions, msg, args, **kwargs):
-        """
-        Called on an interval to check for results of an async salt command.
-        """
-        job_info = self._current_jobs[jid]
-        job_results = self.salt_api.runner('jobs.lookup_jid', jid=jid, returned=True)
-        returned_minions = job_results['return'][0]
-        missing_minions = set(minions).difference(returned_minions.keys())
-
-        if not missing_minions:
-            self.stop_poller(self.async_cmd_poller, args=[jid, minions, msg, args], kwargs=kwargs)
-
-        new_minion_success = []
-        new_minion_failure = {}
-        for minion, states in returned_minions.items():
-            if minion not in job_info['minion_results']:
-                failed_states = []
-                for name, state in states.items():
-                    if not state['result']:
-                        failed_states.append(state)
-                if failed_states:
-                    new_minion_failure[minion] = failed_states
-                    job_info['minion_results'][minion] = failed_states
-                else:
-                    new_minion_success.append(minion)
-                    job_info['minion_results'][minion] = True
-
-        if new_minion_success:
-            self.send_card(
-                title=':smile: Success',
-                body=self._format_results(sorted(new_minion_success), unwrap_singular_list=False),
-                in_reply_to=msg,
-                color='green')
-
-        for minion, results in new_minion_failure.items():
-            failure_text = ' \n\n----\n\n '.join([self._format_failure_state(s) for s in results])
-            self.send_card(
-                title=':rage: Failure',
-                body='- {} \n\n\n {}'.format(minion, failure_text),
-                in_reply_to=msg,
-                color='red')
-
-        if not missing_minions:
-            self.finish_async_cmd(jid, minions, msg, args, **kwargs)
-
-    def async_cmd_poller_timeout(self, jid, minions, msg, args, **kwargs):
-        """
-        Called after async_cmd_poller() is called repeatedly and stop_poller() is never called.
-        """
-        self.finish_async_cmd(jid, minions, msg, args, **kwargs)
+    def storage_count_with_prefix(self, prefix):
+        if hasattr(self._store, 'count_with_prefix'):
+            return self._store.count_with_prefix(prefix)
+        return sum(1 for key in self.keys() if key.startswith(prefix))
 
-    def finish_async_cmd(self, jid, minions, msg, args, **kwargs):
+    def storage_keys_for_term(self, name, term):
         """
-        Clean up after async cmd.
+        Returns the sorted keys whose values list term in their index_terms()[name].
         """
-        if jid in self._current_jobs:
-            job_info = self._current_jobs[jid]
-            del self._current_jobs[jid]
-            missing_minions = sorted(set(minions).difference(job_info['minion_results'].keys()))
-
-            if missing_minions:
-                self.send_card(
-                    title=':dizzy_face: No response',
-                    body=self._format_results(missing_minions, unwrap_singular_list=False),
-                    in_reply_to=msg,
-                    color='yellow')
-
-        message = '**Finished job**'
-        if jid:
-            message += ': {}/molten/job/{}'.format(self.bot_config.SALT_API_URL, jid)
-        self.send(self.message_identifier(msg), message)
+        if hasattr(self._store, 'keys_for_term'):
+            return self._store.keys_for_term(name, term)
+        return sorted(key for key, value in self.items() if term in value.index_terms().get(name, ()))
+
+    def storage_set_many(self, items):
+        if hasattr(self._store, 'set_many'):
+            self._store.set_many(items)
+        else:
+            for key, value in items:
+                self[key] = value
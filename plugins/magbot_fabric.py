@@ -0,0 +1,101 @@
+import threading
+from contextlib import contextmanager
+
+from magbot import lazy_import, monkeypatch
+
+
+def _Connection_run(self, original_method, *args, **kwargs):
+    kwargs['in_stream'] = False
+    return original_method(self, *args, **kwargs)
+
+
+def _Connection_sudo(self, original_method, *args, **kwargs):
+    kwargs['in_stream'] = False
+    return original_method(self, *args, **kwargs)
+
+
+def import_fabric():
+    """
+    Import fabric on first use, and patch Connection.run() and sudo() to
+    never read from stdin.
+    """
+    fabric = lazy_import('fabric')
+    monkeypatch(fabric.Connection, 'run')(_Connection_run)
+    monkeypatch(fabric.Connection, 'sudo')(_Connection_sudo)
+    return fabric
+
+
+class FabricMixin(object):
+    """
+    Fabric automation utilities.
+
+    A single SSH connection is kept open for the lifetime of the plugin, and
+    shared by every thread that uses FabricConnection().
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.fabric_keepalive = 30
+        self._fabric_connection = None
+        self._fabric_lock = threading.RLock()
+        super().__init__(*args, **kwargs)
+
+    def activate(self):
+        self.fabric_connection_kwargs = {
+            'host': self.bot_config.SSH_HOST,
+            'user': self.bot_config.SSH_USERNAME,
+            'config': {
+                'sudo': {
+                    'username': self.bot_config.SSH_USERNAME,
+                    'password': self.bot_config.SSH_PASSWORD,
+                },
+            },
+            'connect_kwargs': {
+                'key_filename': self.bot_config.SSH_KEY,
+            },
+        }
+        self.fabric_keepalive = getattr(self.bot_config, 'SSH_KEEPALIVE', self.fabric_keepalive)
+        super().activate()
+
+    def deactivate(self):
+        self._close_fabric_connection()
+        super().deactivate()
+
+    def _close_fabric_connection(self):
+        with self._fabric_lock:
+            connection = self._fabric_connection
+            self._fabric_connection = None
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    self.log.debug('Failed to close SSH connection', exc_info=True)
+
+    @contextmanager
+    def FabricConnection(self):
+        """
+        Context manager that yields the shared SSH connection, opening a new
+        connection if it was never opened or has been dropped.
+
+        The connection is held exclusively until the with block exits.
+        """
+        fabric = import_fabric()
+        SSHException = lazy_import('paramiko').SSHException
+        with self._fabric_lock:
+            connection = self._fabric_connection
+            if connection is None or not connection.is_connected:
+                self._close_fabric_connection()
+                kwargs = dict(self.fabric_connection_kwargs)
+                kwargs['config'] = fabric.Config(kwargs['config'])
+                connection = fabric.Connection(**kwargs)
+                connection.open()
+                if self.fabric_keepalive:
+                    connection.transport.set_keepalive(self.fabric_keepalive)
+                self._fabric_connection = connection
+                self.log.debug('Opened SSH connection to {}'.format(connection.host))
+
+            try:
+                yield connection
+            except (EOFError, OSError, SSHException):
+                # The connection may be broken, reconnect the next time it's used
+                self._close_fabric_connection()
+                raise
@@ -0,0 +1,1518 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from fnmatch import fnmatchcase
+from functools import partial, wraps
+from weakref import WeakKeyDictionary
+
+from errbot import botcmd
+from errbot.backends.base import Message
+from pockets import is_listy, listify
+
+from magbot import gen, lazy_import
+
+
+class _OutputLimitReached(Exception):
+    pass
+
+
+class BoundedOutput(object):
+    """
+    File-like object that collects text until max_length characters are written.
+    """
+
+    def __init__(self, max_length=None):
+        self.max_length = max_length
+        self.length = 0
+        self.truncated = False
+        self._chunks = []
+
+    def write(self, text):
+        if self.max_length is not None and self.length + len(text) > self.max_length:
+            self._chunks.append(text[:self.max_length - self.length])
+            self.length = self.max_length
+            self.truncated = True
+            raise _OutputLimitReached()
+        self._chunks.append(text)
+        self.length += len(text)
+
+    def getvalue(self):
+        value = ''.join(self._chunks)
+        if self.truncated:
+            # Drop any partially rendered line, unless it's the only one
+            end = value.rfind('\n') + 1
+            if end:
+                value = value[:end]
+            elif value:
+                value = value[:-1] + '\n'
+        return value
+
+
+def import_yaml():
+    """
+    Import yaml on first use, returns the module and the fastest Dumper available.
+    """
+    yaml = lazy_import('yaml')
+    return (yaml, getattr(yaml, 'CDumper', yaml.Dumper))
+
+
+def _yaml_fragments(data):
+    """
+    Split data into top level fragments that render to consecutive YAML blocks.
+    """
+    if isinstance(data, Mapping) and data:
+        try:
+            items = sorted(data.items())
+        except TypeError:
+            items = list(data.items())
+        for key, value in items:
+            yield {key: value}
+    elif isinstance(data, list) and data:
+        for item in data:
+            yield [item]
+    else:
+        yield data
+
+
+def dump_yaml(data, max_length=None):
+    """
+    Render data as block style YAML, using the C emitter if it's available.
+
+    Top level items are rendered one at a time, and rendering stops as soon
+    as max_length characters have been produced. Returns a tuple of the
+    rendered text and the number of top level items that were left out.
+    If the first line alone is too long, it's cut off instead, and its item
+    still counts as left out.
+    """
+    yaml, dumper = import_yaml()
+    output = BoundedOutput(max_length)
+    fragments = list(_yaml_fragments(data))
+    for index, fragment in enumerate(fragments):
+        try:
+            yaml.dump(fragment, output, Dumper=dumper, default_flow_style=False)
+        except _OutputLimitReached:
+            return (output.getvalue(), len(fragments) - index)
+    return (output.getvalue(), 0)
+
+
+# Characters set aside for noting what was left out of truncated results
+_OMITTED_LENGTH = 64
+
+# Fewest characters worth showing a failed state in
+_MIN_FAILURE_STATE_LENGTH = 300
+
+
+def truncate_text(text, max_length):
+    """
+    Cut text down to at most max_length characters, noting how much was cut.
+    """
+    text = str(text)
+    if len(text) <= max_length:
+        return text
+    suffix = '... {} more characters not shown'
+    kept = max(0, max_length - len(suffix.format(len(text))))
+    return text[:kept] + suffix.format(len(text) - kept)
+
+
+def dump_yaml_file(data):
+    """
+    Render data as block style YAML into a temporary file.
+
+    Returns a tuple of the file, rewound to the beginning, and its size in bytes.
+    """
+    yaml, dumper = import_yaml()
+    output = tempfile.TemporaryFile()
+    for fragment in _yaml_fragments(data):
+        yaml.dump(fragment, output, Dumper=dumper, default_flow_style=False, encoding='utf-8')
+    size = output.tell()
+    output.seek(0)
+    return (output, size)
+
+
+@contextmanager
+def null_span(phase):
+    yield
+
+
+def current_task():
+    """
+    Returns the asyncio task running on the current thread, if any.
+    """
+    try:
+        if hasattr(asyncio, 'current_task'):
+            return asyncio.current_task()
+        return asyncio.Task.current_task()
+    except RuntimeError:
+        return None
+
+
+class PerfTrace(object):
+    """
+    The timed spans of a single salt command, linked to the jids it started.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.jids = []
+        self.spans = []
+
+    def add_span(self, phase, started, duration):
+        self.spans.append((phase, started - self.started, duration))
+
+
+class PerfStats(object):
+    """
+    Histograms of the time spent in each phase of salt commands, and the
+    traces of recent commands.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, max_traces=50):
+        self.max_traces = max_traces
+        self.histograms = {}
+        self.traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, phase, started, duration, trace=None):
+        with self._lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0, 'max': 0}
+            histogram['buckets'][bisect_left(self.BUCKETS, duration)] += 1
+            histogram['sum'] += duration
+            histogram['max'] = max(histogram['max'], duration)
+            if trace:
+                trace.add_span(phase, started, duration)
+
+    def link(self, trace, jid):
+        with self._lock:
+            trace.jids.append(jid)
+            self.traces[jid] = trace
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+
+    def quantile(self, phase, q):
+        """
+        Estimates a quantile by interpolating within the histogram buckets.
+        """
+        histogram = self.histograms[phase]
+        rank = q * sum(histogram['buckets'])
+        seen = 0
+        for index, count in enumerate(histogram['buckets']):
+            if count and seen + count >= rank:
+                lower = self.BUCKETS[index - 1] if index else 0
+                upper = self.BUCKETS[index] if index < len(self.BUCKETS) else histogram['max']
+                return min(lower + (upper - lower) * (rank - seen) / count, histogram['max'])
+            seen += count
+        return 0
+
+    def report(self, jid=None):
+        """
+        Returns a plain text report of every phase, or the spans of one job.
+        """
+        lines = []
+        if jid:
+            trace = self.traces.get(jid)
+            if not trace:
+                return None
+            lines.append('{} (jobs: {})'.format(trace.name, ', '.join(trace.jids)))
+            for phase, offset, duration in sorted(trace.spans, key=lambda s: s[1]):
+                lines.append('+{:8.2f}s {:>8.3f}s  {}'.format(offset, duration, phase))
+        else:
+            lines.append('{:<36} {:>7} {:>9} {:>9} {:>9}'.format('phase', 'count', 'p50', 'p95', 'max'))
+            with self._lock:
+                for phase, histogram in sorted(self.histograms.items()):
+                    lines.append('{:<36} {:>7} {:>8.3f}s {:>8.3f}s {:>8.3f}s'.format(
+                        phase,
+                        sum(histogram['buckets']),
+                        self.quantile(phase, 0.5),
+                        self.quantile(phase, 0.95),
+                        histogram['max']))
+        return '\n'.join(lines)
+
+    def prometheus(self, name='magbot_salt_phase_seconds'):
+        """
+        Returns the histograms in the Prometheus text exposition format.
+        """
+        lines = [
+            '# HELP {} Time spent in each phase of salt commands.'.format(name),
+            '# TYPE {} histogram'.format(name),
+        ]
+        with self._lock:
+            for phase, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), histogram['buckets']):
+                    cumulative += count
+                    lines.append('{}_bucket{{phase="{}",le="{}"}} {}'.format(name, phase, bound, cumulative))
+                lines.append('{}_sum{{phase="{}"}} {}'.format(name, phase, histogram['sum']))
+                lines.append('{}_count{{phase="{}"}} {}'.format(name, phase, cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Atomically writes the histograms to path, for the node_exporter textfile collector.
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+def percentile(values, q):
+    """
+    Returns the nearest-rank percentile of values, which must be sorted.
+    """
+    return values[max(0, min(len(values) - 1, int(math.ceil(q * len(values))) - 1))]
+
+
+class JobStats(object):
+    """
+    Per-minion return latency and per-state durations of recent salt jobs.
+
+    Each finished job is kept as a small dict, so the history can be saved
+    to plugin storage as is::
+
+        {
+            'jid': '20180901123456789012',
+            'env': 'prod',
+            'started': 1535780898.7,
+            'minions': {'web1.example.com': 42.1},  # Seconds until the minion returned
+            'missing': {'web2.example.com': 180.3},  # Seconds until the job gave up on the minion
+            'states': {'reggie_venv': 5310},  # Slowest duration of the state, in ms
+        }
+
+    Return times are only as precise as the interval the job was polled at.
+    """
+
+    def __init__(self, history=None, max_jobs=50):
+        self.max_jobs = max_jobs
+        self.history = list(history or [])[-max_jobs:]
+        self.jobs = {}
+
+    def start(self, jid, env=None, started=None):
+        self.jobs[jid] = {
+            'jid': jid,
+            'env': env,
+            'started': time.time() if started is None else started,
+            'minions': {},
+            'missing': {},
+            'states': {},
+        }
+
+    def record_minion(self, jid, minion, states, returned=None):
+        job = self.jobs.get(jid)
+        if not job:
+            return
+        returned = time.time() if returned is None else returned
+        job['minions'][minion] = round(returned - job['started'], 1)
+        if isinstance(states, Mapping):
+            for name, state in states.items():
+                try:
+                    duration = int(float(state.get('duration', 0)))
+                except (AttributeError, TypeError, ValueError):
+                    continue
+                state_id = state.get('__id__') or name
+                job['states'][state_id] = max(duration, job['states'].get(state_id, 0))
+
+    def finish(self, jid, missing=(), finished=None):
+        """
+        Stops tracking a job, recording the minions that never returned as
+        missing since it started.
+        """
+        job = self.jobs.pop(jid, None)
+        if not job:
+            return None
+        finished = time.time() if finished is None else finished
+        for minion in missing:
+            job['missing'][minion] = round(finished - job['started'], 1)
+        if job['minions'] or job['missing']:
+            self.history.append(job)
+            del self.history[:-self.max_jobs]
+        return job
+
+    def slowest(self, env=None, limit=10):
+        """
+        Ranks minions and states by their p95 time across recent jobs.
+
+        Returns two lists of (name, p50, p95, samples, missing) tuples, the
+        first for minion latency in seconds, the second for state durations
+        in ms. A minion that never returned counts as taking as long as the
+        job waited for it, and is counted in missing.
+        """
+        minions = {}
+        states = {}
+        missing = {}
+        for job in self.history:
+            if env and job.get('env') != env:
+                continue
+            for minion, latency in job['minions'].items():
+                minions.setdefault(minion, []).append(latency)
+            for minion, latency in job.get('missing', {}).items():
+                minions.setdefault(minion, []).append(latency)
+                missing[minion] = missing.get(minion, 0) + 1
+            for state_id, duration in job['states'].items():
+                states.setdefault(state_id, []).append(duration)
+
+        def rank(samples):
+            ranked = []
+            for name, values in samples.items():
+                values.sort()
+                ranked.append(
+                    (name, percentile(values, 0.5), percentile(values, 0.95), len(values), missing.get(name, 0)))
+            return sorted(ranked, key=lambda r: (r[2], r[1]), reverse=True)[:limit]
+
+        return (rank(minions), rank(states))
+
+
+class JobState(object):
+    """
+    Compact tracking state for an async salt job.
+
+    Minion ids are interned as positions in self.minions, returned and
+    failed minions are integer bitsets over those positions, and the failed
+    states of each minion are stored once per unique failure signature. The
+    state round trips through to_dict() and from_dict(), so it can be
+    checkpointed to plugin storage and resumed after a restart.
+
+    Signatures only cover the SIGNATURE_KEYS of each failed state, leaving
+    out timings like start_time and duration, which differ on every minion.
+    """
+
+    SIGNATURE_KEYS = ('__id__', '__sls__', 'name', 'comment', 'changes')
+
+    def __init__(
+            self, jid, minions, command, args, targets, reply_to, polls_left, env=None, batch=None, reply_ts=None):
+        self.jid = jid
+        self.minions = list(minions)
+        self._index = {m: i for i, m in enumerate(self.minions)}
+        self.command = command
+        self.args = args
+        self.targets = targets
+        self.reply_to = reply_to
+        self.reply_ts = reply_ts
+        self.polls_left = polls_left
+        self.env = env
+        self.batch = batch
+        self.started = time.time()
+        self.returned = 0
+        self.failed = 0
+        self.failures = {}
+        self.minion_failures = {}
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(
+            data['jid'], data['minions'], data['command'], data['args'], data['targets'], data['reply_to'],
+            data['polls_left'], data.get('env'), data.get('batch'), data.get('reply_ts'))
+        job.started = data['started']
+        job.returned = data['returned']
+        job.failed = data['failed']
+        job.failures = data['failures']
+        job.minion_failures = data['minion_failures']
+        return job
+
+    def to_dict(self):
+        return {
+            'jid': self.jid,
+            'minions': self.minions,
+            'command': self.command,
+            'args': self.args,
+            'targets': self.targets,
+            'reply_to': self.reply_to,
+            'reply_ts': self.reply_ts,
+            'polls_left': self.polls_left,
+            'env': self.env,
+            'batch': self.batch,
+            'started': self.started,
+            'returned': self.returned,
+            'failed': self.failed,
+            'failures': self.failures,
+            'minion_failures': self.minion_failures,
+        }
+
+    def _minions_in(self, bitset):
+        return [m for i, m in enumerate(self.minions) if bitset >> i & 1]
+
+    @property
+    def missing_count(self):
+        return len(self.minions) - bin(self.returned).count('1')
+
+    def is_returned(self, minion):
+        index = self._index.get(minion)
+        return index is not None and bool(self.returned >> index & 1)
+
+    def add_returned(self, minion, failed_states=None):
+        index = self._index.get(minion)
+        if index is None:
+            # The minion returned without being listed as a target
+            index = self._index[minion] = len(self.minions)
+            self.minions.append(minion)
+        self.returned |= 1 << index
+        if failed_states:
+            self.failed |= 1 << index
+            signed = [{key: state.get(key) for key in self.SIGNATURE_KEYS} for state in failed_states]
+            signature = hashlib.sha1(json.dumps(signed, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+            self.failures.setdefault(signature, failed_states)
+            self.minion_failures[index] = signature
+
+    def failed_states(self, minion):
+        signature = self.minion_failures.get(self._index.get(minion))
+        return self.failures.get(signature, [])
+
+    def missing_minions(self):
+        return self._minions_in(~self.returned & ((1 << len(self.minions)) - 1))
+
+    def failed_minions(self):
+        return self._minions_in(self.failed)
+
+
+class SaltAPIException(Exception):
+    pass
+
+
+class AsyncSaltAPI(object):
+    """
+    Asyncio client for the rest_cherrypy Salt API.
+
+    Mirrors the parts of pepper.Pepper that we use, but every request is a
+    coroutine, so any number of requests can be in flight on a single thread.
+    """
+
+    def __init__(self, api_url, timeout=300, span=null_span):
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.span = span
+        self.auth = {}
+        self._session = None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def req(self, path, data=None):
+        if self._session is None:
+            aiohttp = lazy_import('aiohttp')
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'X-Requested-With': 'XMLHttpRequest',
+        }
+        if self.auth.get('token'):
+            headers['X-Auth-Token'] = self.auth['token']
+
+        async with self._session.post(self.api_url + path, data=json.dumps(data), headers=headers) as response:
+            if response.status == 401:
+                raise SaltAPIException('Authentication denied')
+            elif response.status >= 500:
+                raise SaltAPIException('Server error: {}'.format(response.status))
+            return await response.json(content_type=None)
+
+    async def login(self, username, password, eauth):
+        with self.span('api:login'):
+            results = await self.req('/login', {'username': username, 'password': password, 'eauth': eauth})
+        self.auth = results.get('return', [{}])[0]
+        return self.auth
+
+    async def low(self, lowstate, path='/'):
+        with self.span('api:{client}:{fun}'.format(**lowstate[0])):
+            return await self.req(path, lowstate)
+
+    async def local(self, tgt, fun, arg=None, kwarg=None, expr_form='glob', client='local'):
+        low = {'client': client, 'tgt': tgt, 'fun': fun}
+        if arg:
+            low['arg'] = arg
+        if kwarg:
+            low['kwarg'] = kwarg
+        if expr_form:
+            low['expr_form'] = expr_form
+        return await self.low([low])
+
+    async def local_async(self, tgt, fun, arg=None, kwarg=None, expr_form='glob'):
+        return await self.local(tgt, fun, arg, kwarg, expr_form, client='local_async')
+
+    async def runner(self, fun, arg=None, **kwargs):
+        low = {'client': 'runner', 'fun': fun}
+        if arg:
+            low['arg'] = arg
+        low.update(kwargs)
+        return await self.low([low])
+
+
+class SaltEventLoop(object):
+    """
+    An asyncio event loop running on its own thread.
+
+    Coroutines are submitted from other threads with submit(), and blocking
+    calls made from coroutines are run on a small thread pool with
+    run_blocking().
+    """
+
+    def __init__(self, name='Salt event loop', max_workers=2):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=max_workers))
+        self._futures = set()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """
+        Schedule a coroutine on the event loop from any thread.
+
+        Returns a concurrent.futures.Future for the result of the coroutine.
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    def run_blocking(self, func, *args, **kwargs):
+        """
+        Run a blocking function on the thread pool, returns an awaitable.
+        """
+        return self.loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+    def stop(self, *cleanup, timeout=10):
+        """
+        Cancel every submitted coroutine, await any cleanup coroutines, and
+        stop the event loop.
+        """
+        for future in list(self._futures):
+            future.cancel()
+        for coroutine in cleanup:
+            self.submit(coroutine).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self.loop.close()
+
+
+_RE_BATCH_SIZE = re.compile(r'^\d+%?$')
+_RE_ENV_TARGET = re.compile(r'\bG@env:(\S+)')
+
+
+class MinionCache(object):
+    """
+    Index of minion ids by the grains we target on.
+
+    Used to resolve compound targets locally, without a round trip to the
+    Salt API. Instances are never modified after they're built, a refresh
+    replaces the whole cache.
+
+    Like the salt master, grain values are matched case insensitively, so
+    the values are indexed in lowercase and patterns are lowercased.
+    """
+
+    GRAINS = ('roles', 'env', 'event_name', 'event_year')
+
+    def __init__(self, minion_grains):
+        self.updated = time.time()
+        self.minions = frozenset(minion_grains.keys())
+        self.grains = {grain: {} for grain in self.GRAINS}
+        for minion, grains in minion_grains.items():
+            if not isinstance(grains, Mapping):
+                continue  # The minion failed to return its grains
+            for grain in self.GRAINS:
+                for value in listify(grains.get(grain)):
+                    self.grains[grain].setdefault(str(value).lower(), set()).add(minion)
+
+    def _match_grain(self, expression, is_regex=False):
+        grain, _, pattern = expression.partition(':')
+        values = self.grains.get(grain)
+        if values is None:
+            return None
+        pattern = pattern.lower()
+        if is_regex:
+            regex = re.compile(pattern)
+            is_match = regex.match
+        else:
+            def is_match(value):
+                return fnmatchcase(value, pattern)
+
+        matched = set()
+        for value, minions in values.items():
+            if is_match(value):
+                matched.update(minions)
+        return matched
+
+    def _match(self, target):
+        engine, expression = target.split('@', 1) if target[1:2] == '@' else ('', target)
+        if engine == '':
+            return {m for m in self.minions if fnmatchcase(m, expression)}
+        elif engine == 'L':
+            return self.minions.intersection(expression.split(','))
+        elif engine == 'E':
+            regex = re.compile(expression)
+            return {m for m in self.minions if regex.match(m)}
+        elif engine == 'G':
+            return self._match_grain(expression)
+        elif engine == 'P':
+            return self._match_grain(expression, is_regex=True)
+        return None
+
+    def resolve(self, targets):
+        """
+        Returns the set of minion ids matched by a compound target, or None
+        if the target uses syntax that can't be resolved locally, or an
+        invalid regex.
+        """
+        matched = set(self.minions)
+        negate = False
+        for target in targets.split():
+            if target == 'and':
+                continue
+            elif target == 'not':
+                negate = not negate
+                continue
+            elif target in ('or', '(', ')'):
+                return None
+
+            try:
+                minions = self._match(target)
+            except re.error:
+                return None  # Leave it to the salt master to report the bad pattern
+            if minions is None:
+                return None
+            matched = matched.difference(minions) if negate else matched.intersection(minions)
+            negate = False
+        return matched
+
+
+class SaltMixin(object):
+    """
+    Salt API utilities.
+    """
+
+    @staticmethod
+    def _validate_grain_args(grains, grain_args):
+        for grain_arg in grain_args:
+            name = grain_arg['name']
+            value = grains.get(name)
+            if value:
+                if value in grain_arg.get('ignore', []):
+                    return True
+                choices = grain_arg.get('choices', [])
+                if choices and value not in choices:
+                    return 'unknown {}: \`{}\`, valid values: {}'.format(name, value, ', '.join(choices))
+                value_type = grain_arg.get('type', str)
+                try:
+                    value_type(value)
+                except Exception:
+                    return 'invalid {}: \`{}\`'.format(name, value)
+            elif grain_arg.get('required'):
+                return '{} is required'.format(name)
+        return None
+
+    @staticmethod
+    def parse_target_args(default_targets=None, grain_args=[]):
+        """
+        Decorator to parse salt targets from command args.
+        """
+        grain_args_usage = ' '.join(
+            [g['name'] if g.get('required') else '[{}]'.format(g['name']) for g in grain_args] + ['[roles:(web|db)]'])
+
+        def decorator(func):
+            @wraps(func)
+            def with_parse_target_args(self, msg, args, **kwargs):
+                args = args.split()
+                grain_names = [g['name'] for g in reversed(grain_args)]
+                grains = OrderedDict()
+                regex_grains = []
+                extra_targets = []
+                for arg in args:
+                    if '@' in arg:
+                        extra_targets.append(arg)
+                    elif ':' in arg:
+                        regex_grains.append(arg)
+                    elif grain_names:
+                        grains[grain_names.pop()] = arg
+                    else:
+                        extra_targets.append(arg)
+
+                error = SaltMixin._validate_grain_args(grains, grain_args)
+                if error is True:
+                    yield None  # We hit a value that should be ignored
+                elif error:
+                    yield 'Parse error: {} \n ' \
+                        'Usage: \`{}{} {}\`'.format(error, self._bot.prefix, func.__name__, grain_args_usage)
+                else:
+                    targets = [default_targets] if default_targets else []
+                    for grain, value in grains.items():
+                        targets.append('G@{}:{}'.format(grain, value))
+                    for regex_grain in regex_grains:
+                        targets.append('P@{}'.format(regex_grain))
+                    for extra_target in extra_targets:
+                        targets.append(extra_target)
+                    targets = ' and '.join(targets)
+
+                    if (default_targets or grain_args) and self._resolve_targets(targets) == set():
+                        yield 'No servers match {}'.format(' '.join(args))
+                    else:
+                        yield from gen(func)(self, msg, args, targets, **kwargs)
+
+            return with_parse_target_args
+
+        if callable(default_targets):
+            func = default_targets
+            default_targets = None
+            return decorator(func)
+        else:
+            return decorator
+
+    @staticmethod
+    def api_auth(func):
+        """
+        Decorator to authenticate against the Salt API before awaiting the coroutine function.
+        """
+        @wraps(func)
+        async def with_api_auth(self, *args, **kwargs):
+            old_token = self._cached_api_auth.get('token')
+            await self._renew_api_auth()
+            new_token = self._cached_api_auth.get('token')
+            try:
+                return await func(self, *args, **kwargs)
+            except SaltAPIException as error:
+                if old_token == new_token and 'authentication denied' in str(error).lower():
+                    self.log.debug('Cached Salt API token failed, attempting to update')
+                    self._cached_api_auth = {}
+                    await self._renew_api_auth()
+                    return await func(self, *args, **kwargs)
+                else:
+                    raise error
+
+        return with_api_auth
+
+    @staticmethod
+    def cmd(salutation=None, default_targets=None, grain_args=[]):
+        """
+        Decorator to format results from the Salt API.
+
+        The decorated coroutine function runs on the Salt event loop, and
+        its results are sent when they arrive, so the command doesn't hold
+        on to one of errbot's worker threads.
+        """
+        def decorator(func):
+            @botcmd
+            @wraps(func)
+            @SaltMixin.parse_target_args(default_targets, grain_args)
+            def with_salt_cmd(self, msg, args, targets):
+                if salutation:
+                    yield salutation.format(args=' '.join(args))
+
+                self._submit_salt_task(msg, self._run_salt_cmd(func, msg, args, targets), func.__name__)
+
+            return with_salt_cmd
+
+        if callable(salutation):
+            func = salutation
+            salutation = None
+            return decorator(func)
+        else:
+            return decorator
+
+    @staticmethod
+    def _parse_batch_args(args):
+        """
+        Pops the --batch and --max-fail options off of the command args.
+
+        Returns a tuple of the remaining args, the batch size, and the
+        maximum number of failures. Sizes are either a number of servers
+        or a percentage of the target servers, like "25%".
+        """
+        remaining = []
+        options = {'--batch': None, '--max-fail': '0'}
+        words = iter(args.split())
+        for word in words:
+            name, _, value = word.partition('=')
+            if name in options:
+                value = value or next(words, '')
+                if not _RE_BATCH_SIZE.match(value) or (name == '--batch' and not value.strip('0%')):
+                    raise ValueError('invalid {}: `{}`'.format(name, value))
+                options[name] = value
+            else:
+                remaining.append(word)
+        return (' '.join(remaining), options['--batch'], options['--max-fail'])
+
+    @staticmethod
+    def _batch_size(size, total):
+        if size.endswith('%'):
+            return int(total * int(size[:-1]) / 100)
+        return int(size)
+
+    @staticmethod
+    def async_cmd(
+            salutation=None, default_targets=None, grain_args=[], interval=20, times=9, batch=False, prepare=None):
+        """
+        Decorator to poll for asynchronous results from the Salt API.
+
+        Like cmd(), the decorated coroutine function and the polling for its
+        results run on the Salt event loop. If batch is True, the command accepts "--batch SIZE" to roll through
+        the target servers in waves, and "--max-fail SIZE" to stop the
+        rollout once more than that many servers have failed.
+
+        If set, the prepare coroutine function is awaited once before the
+        command starts, with no arguments but self. In a rollout, it runs
+        before the first wave, not before every wave.
+        """
+        def decorator(func):
+            @wraps(func)
+            @SaltMixin.parse_target_args(default_targets, grain_args)
+            def start_salt_async_cmd(self, msg, args, targets, batch_size=None, max_failures='0'):
+                if salutation:
+                    yield salutation.format(args=' '.join(args))
+
+                if batch_size:
+                    self._submit_salt_task(msg, self._start_batch_async_cmd(
+                        func.__name__, msg, args, targets, batch_size, max_failures), func.__name__)
+                else:
+                    self._submit_salt_task(
+                        msg, self._start_async_cmd(func.__name__, msg, args, targets), func.__name__)
+
+            @botcmd
+            @wraps(func)
+            def with_salt_async_cmd(self, msg, args):
+                if batch:
+                    try:
+                        args, batch_size, max_failures = SaltMixin._parse_batch_args(args)
+                    except ValueError as error:
+                        yield 'Parse error: {}'.format(error)
+                        return
+                    yield from start_salt_async_cmd(
+                        self, msg, args, batch_size=batch_size, max_failures=max_failures)
+                else:
+                    yield from start_salt_async_cmd(self, msg, args)
+
+            with_salt_async_cmd._salt_async_cmd = (func, interval, times)
+            with_salt_async_cmd._salt_async_prepare = prepare
+            return with_salt_async_cmd
+
+        if callable(salutation):
+            func = salutation
+            salutation = None
+            return decorator(func)
+        else:
+            return decorator
+
+    def __init__(self, *args, **kwargs):
+        self.salt_api = None
+        self._salt_loop = None
+        self._cached_api_auth = {}
+        self._api_auth_lock = None
+        self._current_jobs = {}
+        self.results_max_length = 3000
+        self.results_upload = True
+        self.minion_cache_interval = 300
+        self.poll_interval = None
+        self._minion_cache = None
+        self._traces_by_task = WeakKeyDictionary()
+        self.metrics_file = None
+        self.metrics_interval = 15
+        self.perf = PerfStats()
+        self.job_stats = JobStats()
+        super().__init__(*args, **kwargs)
+
+    def activate(self):
+        self.results_max_length = getattr(self.bot_config, 'SALT_RESULTS_MAX_LENGTH', self.results_max_length)
+        self.results_upload = getattr(self.bot_config, 'SALT_RESULTS_UPLOAD', self.results_upload)
+        self.minion_cache_interval = getattr(
+            self.bot_config, 'SALT_MINION_CACHE_INTERVAL', self.minion_cache_interval)
+        self.poll_interval = getattr(self.bot_config, 'SALT_POLL_INTERVAL', self.poll_interval)
+        try:
+            self.salt_api = AsyncSaltAPI(self.bot_config.SALT_API_URL, span=self.perf_span)
+            self.log.debug('Salt API: {}'.format(self.bot_config.SALT_API_URL))
+        except Exception:
+            self.log.error('Failed to initialize Salt API: {}'.format(self.bot_config.SALT_API_URL), exc_info=True)
+            raise
+        self._salt_loop = SaltEventLoop(max_workers=getattr(self.bot_config, 'SALT_BLOCKING_THREADS', 2))
+        super().activate()
+
+        if self.minion_cache_interval:
+            self._salt_loop.submit(self._poll_minion_cache())
+
+        self.job_stats = JobStats(
+            self.get('salt_job_stats', []), getattr(self.bot_config, 'SALT_JOB_STATS_HISTORY', 50))
+
+        self.metrics_file = getattr(self.bot_config, 'SALT_METRICS_FILE', self.metrics_file)
+        if self.metrics_file:
+            self._salt_loop.submit(self._poll_metrics_file())
+
+        self._resume_async_cmds()
+
+    def deactivate(self):
+        if self._salt_loop:
+            self._salt_loop.stop(self.salt_api.close())
+            self._salt_loop = None
+        # The next activation starts a new Salt API client, and event loop
+        self._cached_api_auth = {}
+        self._api_auth_lock = None
+        self._current_jobs = {}
+        super().deactivate()
+
+    def run_blocking(self, func, *args, **kwargs):
+        """
+        Call a blocking function from a coroutine without blocking the Salt event loop.
+        """
+        return self._salt_loop.run_blocking(func, *args, **kwargs)
+
+    def _submit_salt_task(self, msg, coroutine, name):
+        """
+        Run a coroutine on the Salt event loop, replying with any error it raises.
+
+        Every span recorded while the coroutine runs is added to a new trace.
+        """
+        async def with_error_reply():
+            trace = PerfTrace(name)
+            self._traces_by_task[current_task()] = trace
+            try:
+                with self.perf_span('cmd:{}'.format(name)):
+                    return await coroutine
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.log.error('Salt command failed', exc_info=True)
+                await self._send(msg, 'Salt command failed: `{}`'.format(error))
+
+        return self._salt_loop.submit(with_error_reply())
+
+    def _current_trace(self):
+        task = current_task()
+        return self._traces_by_task.get(task) if task else None
+
+    @contextmanager
+    def perf_span(self, phase):
+        """
+        Context manager that records the time spent in a phase of a salt
+        command, and adds it to the command's trace.
+        """
+        trace = self._current_trace()
+        started = time.time()
+        timer = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.perf.record(phase, started, time.perf_counter() - timer, trace)
+
+    async def _poll_metrics_file(self):
+        """
+        Writes the phase histograms to the metrics file on an interval.
+        """
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            try:
+                await self.run_blocking(self.perf.write_prometheus, self.metrics_file)
+            except OSError:
+                self.log.warning('Failed to write metrics file: {}'.format(self.metrics_file), exc_info=True)
+
+    def _send_timer(self):
+        """
+        Returns an on_sent callback for the outbound queue, that records how
+        long a message waited in the queue and how long it took to send.
+        """
+        trace = self._current_trace()
+
+        def on_sent(started, waited, duration):
+            self.perf.record('send_wait', started - waited, waited, trace)
+            self.perf.record('send', started, duration, trace)
+        return on_sent
+
+    async def _send(self, msg, text, background=False):
+        self.send(
+            self.message_identifier(msg), text, in_reply_to=msg, background=background, on_sent=self._send_timer())
+
+    async def _send_card(self, msg, background=False, **kwargs):
+        self.send_card(in_reply_to=msg, background=background, on_sent=self._send_timer(), **kwargs)
+
+    def _format_async_results(self, args, jid, minions):
+        if jid:
+            message = ['**Started job**: {}/molten/job/{}'.format(self.bot_config.SALT_API_URL, jid)]
+            if len(minions) == 1:
+                message.append('**Target server**: {}'.format(minions[0]))
+            elif minions:
+                message.append('**Target servers**: \n {}'.format(self._format_results(sorted(minions))))
+            return ' \n '.join(message)
+        return 'No job started, no servers found for {}'.format(' '.join(args))
+
+    def _format_failure_state(self, state, max_length=None):
+        """
+        Formats a failed state in at most max_length characters. The comment
+        gets up to half of them, and the changes get whatever is left.
+
+        Returns a tuple of the text and whether any of it was cut off.
+        """
+        max_length = self.results_max_length if max_length is None else max_length
+        fields = []
+        if state.get('__id__'):
+            fields.append(('*ID*', state['__id__'], max_length // 8))
+        elif state.get('name'):
+            fields.append(('*Name*', state['name'], max_length // 8))
+        if state.get('__sls__'):
+            fields.append(('*SLS*', state['__sls__'], max_length // 8))
+        if state.get('comment'):
+            fields.append(('*Comment*', state['comment'], max_length // 2))
+
+        results = []
+        truncated = False
+        for label, value, length in fields:
+            text = truncate_text(value, length)
+            truncated = truncated or text != str(value)
+            results.append('{}: {}'.format(label, text))
+
+        changes_format = '*Changes*: \n```\n{}```'
+        used = sum(len(r) + 3 for r in results) + len(changes_format.format('')) + _OMITTED_LENGTH
+        with self.perf_span('format'):
+            changes, omitted = dump_yaml(state.get('changes', {}), max_length=max(0, max_length - used))
+        results.append(changes_format.format(self._format_omitted(changes, omitted)))
+        return (' \n '.join(results), truncated or bool(omitted))
+
+    def _format_failure(self, minion, states, uploading=False):
+        """
+        Formats the failed states of a minion as a card body of at most
+        results_max_length characters. Each state gets an equal share, and
+        the states that don't fit are left out.
+
+        Returns a tuple of the body and whether any of it was cut off.
+        """
+        separator = ' \n\n----\n\n '
+        body = '- {} \n\n\n '.format(minion)
+        remaining = self.results_max_length - len(body) - _OMITTED_LENGTH
+        share = max(remaining // max(1, len(states)), min(remaining, _MIN_FAILURE_STATE_LENGTH))
+        texts = []
+        truncated = False
+        for state in states:
+            if remaining < min(share, _MIN_FAILURE_STATE_LENGTH):
+                break
+            text, cut = self._format_failure_state(state, min(share, remaining))
+            texts.append(text)
+            truncated = truncated or cut
+            remaining -= len(text) + len(separator)
+
+        notes = []
+        omitted = len(states) - len(texts)
+        if omitted:
+            notes.append('{} more failed state{} not shown'.format(omitted, '' if omitted == 1 else 's'))
+        truncated = truncated or bool(omitted)
+        if truncated and uploading:
+            notes.append('uploading full results')
+        if notes:
+            texts.append('... {}'.format(', '.join(notes)))
+        return (body + separator.join(texts), truncated)
+
+    def _format_omitted(self, text, omitted, uploading=False):
+        if omitted:
+            text += '... {} more not shown'.format(omitted)
+            if uploading:
+                text += ', uploading full results'
+        return text
+
+    def _format_results(self, results, unwrap_singular_list=True, max_length=None):
+        return self._format_omitted(*self._render_results(results, unwrap_singular_list, max_length))
+
+    @staticmethod
+    def _unwrap_results(results, unwrap_singular_list=True):
+        if isinstance(results, Mapping):
+            if results.get('return'):
+                results = results['return']
+
+        while unwrap_singular_list and is_listy(results) and len(results) == 1:
+            results = results[0]
+        return results
+
+    def _render_results(self, results, unwrap_singular_list=True, max_length=None):
+        """
+        Render results as YAML, truncated to max_length characters.
+
+        Returns a tuple of the rendered text and the number of top level
+        items that were left out.
+        """
+        results = self._unwrap_results(results, unwrap_singular_list)
+        with self.perf_span('format'):
+            return dump_yaml(results, max_length=self.results_max_length if max_length is None else max_length)
+
+    def _upload_results(self, msg, results, name='results'):
+        """
+        Upload the complete, untruncated results as a YAML file.
+        """
+        output, size = dump_yaml_file(self._unwrap_results(results))
+        self.send_stream_request(
+            self.message_identifier(msg), output, name='{}.yaml'.format(name), size=size, stream_type='text/yaml')
+
+    async def _renew_api_auth(self):
+        """
+        The Salt API returns an auth dictionary that looks like this::
+
+            self._cached_api_auth = {
+                'user': 'username',
+                'perms': [{'*': ['.*']}],
+                'eauth': 'ldap',
+                'start': 1535780898.745305,
+                'expire': 1535824098.745305,
+                'token': 'XXXXXXXXXXXXX',
+            }
+        """
+        if self._api_auth_lock is None:
+            self._api_auth_lock = asyncio.Lock()
+
+        with self.perf_span('auth'):
+            async with self._api_auth_lock:
+                if self._cached_api_auth.get('expire'):
+                    expiration = datetime.fromtimestamp(self._cached_api_auth['expire'])
+                    seconds_to_expiration = (expiration - datetime.utcnow()).total_seconds()
+                    if seconds_to_expiration > 900:
+                        # The auth token won't expire for at least 15 minutes
+                        self.log.debug('Using cached Salt API auth token')
+                        return
+
+                try:
+                    self._cached_api_auth = await self.salt_api.login(
+                        self.bot_config.SALT_USERNAME, self.bot_config.SALT_PASSWORD, self.bot_config.SALT_AUTH)
+                    self.log.debug('Updated cached Salt API auth token')
+                except Exception:
+                    self.log.error('Failed to authenticate against Salt API: user="{}", auth="{}"'.format(
+                        self.bot_config.SALT_USERNAME, self.bot_config.SALT_AUTH), exc_info=True)
+                    raise
+
+    async def _run_salt_cmd(self, func, msg, args, targets):
+        """
+        Runs a salt command and replies with its formatted results.
+        """
+        results = await SaltMixin.api_auth(func)(self, msg, args, targets)
+        text, omitted = self._render_results(results)
+        if omitted and self.results_upload:
+            await self._send(msg, self._format_omitted(text, omitted, uploading=True))
+            await self.run_blocking(self._upload_results, msg, results, func.__name__)
+        else:
+            await self._send(msg, self._format_omitted(text, omitted))
+
+    def _async_cmd_schedule(self, command):
+        """
+        Returns the coroutine function of an async command, and the seconds
+        between polls for its results and how many times to poll.
+
+        SALT_POLL_INTERVAL overrides the interval of every command, and
+        scales the number of polls so jobs still time out at the same time.
+        """
+        func, interval, times = getattr(self, command)._salt_async_cmd
+        if self.poll_interval:
+            times = int(math.ceil(interval * times / self.poll_interval))
+            interval = self.poll_interval
+        return (func, interval, times)
+
+    async def _prepare_async_cmd(self, command):
+        prepare = getattr(self, command)._salt_async_prepare
+        if prepare:
+            await prepare(self)
+
+    async def _start_async_cmd(self, command, msg, args, targets, env=None, batch=None, background=False):
+        """
+        Starts an async salt command and polls for its results. The job is
+        tracked under env, or the env in targets, for salt slowest. Results
+        are always sent as background messages, and so is the job's start
+        if background is True.
+
+        Returns the minions that failed or never responded, or None if no
+        job was started.
+        """
+        func, interval, times = self._async_cmd_schedule(command)
+        if batch is None:
+            await self._prepare_async_cmd(command)
+        async_results = await SaltMixin.api_auth(func)(self, msg, args, targets)
+        results = async_results['return'][0]
+        jid = results.get('jid', None)
+        minions = results.get('minions', [])
+        await self._send(msg, self._format_async_results(args, jid, minions), background=background)
+
+        if jid:
+            trace = self._current_trace()
+            if trace:
+                self.perf.link(trace, jid)
+            job = JobState(
+                jid, minions, command, args, targets, str(self.message_identifier(msg)), times,
+                env=env or self._target_env(targets), batch=batch, reply_ts=self._message_ts(msg))
+            self._current_jobs[jid] = job
+            self.job_stats.start(jid, job.env, job.started)
+            await self._checkpoint_jobs()
+            return await self._poll_async_cmd(job, msg, interval)
+
+    async def _start_batch_async_cmd(self, command, msg, args, targets, batch_size, max_failures):
+        """
+        Splits the target servers into waves, and runs each wave in turn
+        until too many servers have failed.
+        """
+        await self._prepare_async_cmd(command)
+        minions = await self._list_target_minions(targets)
+        if not minions:
+            await self._send(msg, 'No job started, no servers found for {}'.format(' '.join(args)))
+            return
+
+        size = max(1, self._batch_size(batch_size, len(minions)))
+        batch = {
+            'waves': [minions[i:i + size] for i in range(0, len(minions), size)],
+            'wave': 0,
+            'max_failures': self._batch_size(max_failures, len(minions)),
+            'failed': [],
+            'env': self._target_env(targets),
+        }
+        await self._send(msg, '**Rolling out** to {} servers in {} waves, stopping after {} failures'.format(
+            len(minions), len(batch['waves']), batch['max_failures'] + 1))
+        await self._run_batch_waves(command, msg, args, batch)
+
+    async def _run_batch_waves(self, command, msg, args, batch):
+        while batch['wave'] < len(batch['waves']):
+            wave = batch['waves'][batch['wave']]
+            background = batch['wave'] > 0
+            await self._send(
+                msg, '**Starting wave** {}/{}'.format(batch['wave'] + 1, len(batch['waves'])), background=background)
+            wave_failed = await self._start_async_cmd(
+                command, msg, args, 'L@' + ','.join(wave), env=batch['env'], batch=batch, background=background)
+            if not await self._finish_batch_wave(msg, batch, wave if wave_failed is None else wave_failed):
+                return
+
+    async def _finish_batch_wave(self, msg, batch, failed):
+        """
+        Reports progress after a wave finishes.
+
+        Returns True if the rollout should continue with the next wave.
+        """
+        batch['failed'].extend(failed)
+        batch['wave'] += 1
+        waves = batch['waves']
+        progress = '{}/{} servers, {} failed'.format(
+            sum(len(w) for w in waves[:batch['wave']]), sum(len(w) for w in waves), len(batch['failed']))
+
+        if len(batch['failed']) > batch['max_failures']:
+            await self._send(msg, '**Stopped rollout** after wave {}/{}: {}'.format(
+                batch['wave'], len(waves), progress), background=True)
+            return False
+        elif batch['wave'] < len(waves):
+            await self._send(
+                msg, '**Finished wave** {}/{}: {}'.format(batch['wave'], len(waves), progress), background=True)
+            return True
+        await self._send(msg, '**Finished rollout**: {}'.format(progress), background=True)
+        return False
+
+    async def _checkpoint_jobs(self):
+        """
+        Saves the state of every job in flight to plugin storage.
+        """
+        jobs = {jid: job.to_dict() for jid, job in self._current_jobs.items()}
+        await self.run_blocking(self.__setitem__, 'salt_jobs', jobs)
+
+    def _resume_async_cmds(self):
+        """
+        Resumes polling for the jobs that were in flight when the plugin was
+        last deactivated. Jobs that can't be resumed, like ones replying to a
+        channel that's gone, are logged and dropped from the checkpoint.
+        """
+        jobs = self.get('salt_jobs', {})
+        for jid, data in list(jobs.items()):
+            try:
+                job = JobState.from_dict(data)
+                msg = Message(
+                    frm=self.build_identifier(job.reply_to),
+                    to=self.bot_identifier,
+                    extras={'slack_event': {'ts': job.reply_ts}} if job.reply_ts else None)
+            except Exception:
+                self.log.error('Failed to resume Salt job {}'.format(jid), exc_info=True)
+                del jobs[jid]
+                self['salt_jobs'] = jobs
+                continue
+            self._current_jobs[jid] = job
+            self.job_stats.start(jid, job.env, job.started)
+            self._submit_salt_task(msg, self._resume_async_cmd(job, msg), job.command)
+
+    async def _resume_async_cmd(self, job, msg):
+        try:
+            _, interval, _ = self._async_cmd_schedule(job.command)
+            await self._send(msg, '**Resumed job**: {}/molten/job/{}, waiting on {} servers'.format(
+                self.bot_config.SALT_API_URL, job.jid, job.missing_count), background=True)
+        except Exception:
+            # Drop the job, rather than failing to resume it on every activation
+            self._current_jobs.pop(job.jid, None)
+            self.job_stats.jobs.pop(job.jid, None)
+            await self._checkpoint_jobs()
+            raise
+
+        failed = await self._poll_async_cmd(job, msg, interval)
+        if job.batch and await self._finish_batch_wave(msg, job.batch, failed):
+            await self._run_batch_waves(job.command, msg, job.args, job.batch)
+
+    @staticmethod
+    def _message_ts(msg):
+        """
+        Returns the Slack timestamp of msg, that replies to it are threaded
+        under, or None if it isn't a Slack message.
+        """
+        event = (msg.extras or {}).get('slack_event') or {}
+        return event.get('message', event).get('ts')
+
+    @staticmethod
+    def _target_env(targets):
+        match = _RE_ENV_TARGET.search(targets)
+        return match.group(1) if match else None
+
+    async def _list_target_minions(self, targets):
+        """
+        Returns a sorted list of the minion ids the salt master matches with targets.
+
+        The master is asked, rather than the minion cache, so minions that
+        missed the last cache refresh aren't left out of a rollout. Starting
+        a test.ping job lists every matched minion, even ones that won't
+        respond, without waiting for them.
+        """
+        await self._renew_api_auth()
+        results = await self.salt_api.local_async(targets, 'test.ping', expr_form='compound')
+        return sorted(results['return'][0].get('minions', []))
+
+    async def _poll_minion_cache(self):
+        """
+        Refreshes the cached minion ids and grains on an interval.
+        """
+        while True:
+            await self._refresh_minion_cache()
+            await asyncio.sleep(self.minion_cache_interval)
+
+    async def _refresh_minion_cache(self):
+        """
+        Rebuilds the minion cache from the salt master's grain cache.
+
+        The master's cache still has the grains of minions that are down,
+        so they can be targeted, and no job is run across the fleet.
+        """
+        try:
+            await self._renew_api_auth()
+            results = await self.salt_api.runner('cache.grains', tgt='*')
+            self._minion_cache = MinionCache(results['return'][0])
+            self.log.debug('Cached grains for {} minions'.format(len(self._minion_cache.minions)))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.log.warning('Failed to refresh minion cache', exc_info=True)
+
+    def _fresh_minion_cache(self):
+        """
+        Returns the minion cache, or None if it's missing or stale.
+        """
+        cache = self._minion_cache
+        if not cache or time.time() - cache.updated > self.minion_cache_interval * 3:
+            return None
+        return cache
+
+    def _resolve_targets(self, targets):
+        """
+        Returns the set of minion ids matched by targets, or None if the
+        minion cache is missing or stale, or the targets can't be resolved
+        locally.
+        """
+        cache = self._fresh_minion_cache()
+        return cache.resolve(targets) if cache else None
+
+    async def _poll_async_cmd(self, job, msg, interval):
+        """
+        Calls async_cmd_poller() on an interval until every minion has
+        returned, or the job runs out of polls.
+        """
+        while job.polls_left > 0:
+            await asyncio.sleep(interval)
+            job.polls_left -= 1
+            try:
+                await self._renew_api_auth()
+                with self.perf_span('poll'):
+                    finished = await self.async_cmd_poller(job, msg)
+                await self._checkpoint_jobs()
+                if finished:
+                    break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.error('Failed to poll Salt job {}'.format(job.jid), exc_info=True)
+        return await self.finish_async_cmd(job, msg)
+
+    async def async_cmd_poller(self, job, msg):
+        """
+        Called on an interval to check for results of an async salt command.
+
+        Returns True once every minion has returned.
+        """
+        job_results = await self.salt_api.runner('jobs.lookup_jid', jid=job.jid, returned=True)
+        returned_minions = job_results['return'][0]
+
+        new_minion_success = []
+        new_minion_failure = []
+        for minion, states in returned_minions.items():
+            if not job.is_returned(minion):
+                self.job_stats.record_minion(job.jid, minion, states)
+                failed_states = []
+                for name, state in states.items():
+                    if not state['result']:
+                        failed_states.append(state)
+                job.add_returned(minion, failed_states)
+                if failed_states:
+                    new_minion_failure.append(minion)
+                else:
+                    new_minion_success.append(minion)
+
+        if new_minion_success:
+            await self._send_card(
+                msg,
+                background=True,
+                title=':smile: Success',
+                body=self._format_results(sorted(new_minion_success), unwrap_singular_list=False),
+                color='green')
+
+        for minion in new_minion_failure:
+            await self._send_failure(msg, minion, job.failed_states(minion))
+
+        return job.missing_count == 0
+
+    async def _send_failure(self, msg, minion, states):
+        """
+        Sends a card with the failed states of a minion, and uploads them in
+        full if they didn't fit.
+        """
+        body, truncated = self._format_failure(minion, states, uploading=self.results_upload)
+        await self._send_card(msg, background=True, title=':rage: Failure', body=body, color='red')
+        if truncated and self.results_upload:
+            await self.run_blocking(self._upload_results, msg, {minion: states}, 'failures-{}'.format(minion))
+
+    async def finish_async_cmd(self, job, msg):
+        """
+        Clean up after async cmd.
+
+        Returns the minions that failed or never responded.
+        """
+        missing_minions = sorted(job.missing_minions())
+        if self.job_stats.finish(job.jid, missing_minions):
+            await self.run_blocking(self.__setitem__, 'salt_job_stats', self.job_stats.history)
+
+        self._current_jobs.pop(job.jid, None)
+        await self._checkpoint_jobs()
+        if missing_minions:
+            await self._send_card(
+                msg,
+                background=True,
+                title=':dizzy_face: No response',
+                body=self._format_results(missing_minions, unwrap_singular_list=False),
+                color='yellow')
+
+        await self._send(
+            msg, '**Finished job**: {}/molten/job/{}'.format(self.bot_config.SALT_API_URL, job.jid), background=True)
+        return missing_minions + job.failed_minions()
@@ -1,24 +1,191 @@
+import json
 import re
+import tempfile
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict
 
 from errbot import BotPlugin, botcmd, re_botcmd
 
+from magbot import MagbotMixin, lazy_import
+
 
 _REMEMBER_SPLIT_RE = re.compile(r'\s+is[\s\n]+', flags=re.IGNORECASE)
+_REMEMBER_PAGE_RE = re.compile(r'^(.*?)\s*\bpage\s+(\d+)$', flags=re.IGNORECASE)
+
+_EXPORT_FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'yaml': 'text/yaml',
+}
+
+
+def _parse_memories(text):
+    """
+    Parses memories from JSON Lines, with a key and value on each line, or
+    from a YAML mapping of keys to values.
+
+    Returns an OrderedDict of lowercase keys to values. Raises ValueError
+    if the text can't be parsed.
+    """
+    text = text.strip().strip('`').strip()
+    memories = OrderedDict()
+    if text.startswith('{'):
+        for number, line in enumerate(text.splitlines(), 1):
+            if line.strip():
+                try:
+                    item = json.loads(line)
+                    memories[str(item['key']).strip().lower()] = str(item['value']).strip()
+                except (ValueError, KeyError, TypeError):
+                    raise ValueError('line {} is not a JSON object with a key and a value'.format(number))
+    elif text:
+        yaml = lazy_import('yaml')
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError as ex:
+            raise ValueError('it is not valid JSON Lines or YAML ({})'.format(ex))
+        if not isinstance(data, dict):
+            raise ValueError('the YAML is not a mapping of keys to values')
+        for key, value in data.items():
+            memories[str(key).strip().lower()] = str(value).strip()
+
+    if '' in memories:
+        raise ValueError('a memory has an empty key')
+    return memories
+
+
+class NGramIndex(object):
+    """
+    Index of keys by their character trigrams, to find the keys most
+    similar to a misspelled one without comparing it to every key.
+    """
+
+    N = 3
+
+    def __init__(self, keys=()):
+        self._keys = {}
+        self._postings = defaultdict(set)
+        for key in keys:
+            self.add(key)
+
+    @classmethod
+    def ngrams(cls, key):
+        padded = ' ' * (cls.N - 1) + key + ' '
+        return frozenset(padded[i:i + cls.N] for i in range(len(padded) - cls.N + 1))
+
+    def add(self, key):
+        if key not in self._keys:
+            self._keys[key] = ngrams = self.ngrams(key)
+            for ngram in ngrams:
+                self._postings[ngram].add(key)
+
+    def remove(self, key):
+        for ngram in self._keys.pop(key, ()):
+            postings = self._postings[ngram]
+            postings.discard(key)
+            if not postings:
+                del self._postings[ngram]
+
+    def similar(self, key, limit=3, min_score=0.4):
+        """
+        Returns up to limit keys, most similar first, that share enough
+        trigrams with key. Similarity is the Dice coefficient of the trigrams.
+        """
+        ngrams = self.ngrams(key)
+        shared = Counter()
+        for ngram in ngrams:
+            shared.update(self._postings.get(ngram, ()))
+
+        scored = []
+        for candidate, count in shared.items():
+            score = 2.0 * count / (len(ngrams) + len(self._keys[candidate]))
+            if score >= min_score:
+                scored.append((-score, candidate))
+        return [candidate for _, candidate in sorted(scored)[:limit]]
+
+
+class Remember(MagbotMixin, BotPlugin):
+
+    PAGE_SIZE = 40
+
+    def __init__(self, *args, **kwargs):
+        self._keys = []
+        self._ngrams = NGramIndex()
+        self._keys_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
 
+    def activate(self):
+        super().activate()
+        with self._keys_lock:
+            self._keys = self.storage_keys_with_prefix('')
+            self._ngrams = NGramIndex(self._keys)
 
-class Remember(BotPlugin):
+    def _prefix_range(self, prefix):
+        """
+        Returns the start and stop positions of the keys starting with prefix.
+        """
+        start = bisect_left(self._keys, prefix)
+        if not prefix:
+            return (start, len(self._keys))
+        return (start, bisect_left(self._keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start))
 
     def _get_memory(self, key, escape=True):
-        value = self[key.lower()]
+        value = self.storage_get_lower(key)
         if escape:
             value = value.replace('`', '\`')
         return value
 
+    def _has_key(self, key):
+        index = bisect_left(self._keys, key)
+        return index < len(self._keys) and self._keys[index] == key
+
     def _set_memory(self, key, value=None):
-        if value is None:
-            del self[key.lower()]
-        else:
-            self[key.lower()] = value
+        key = key.lower()
+        with self._keys_lock:
+            index = bisect_left(self._keys, key)
+            exists = index < len(self._keys) and self._keys[index] == key
+            if value is None:
+                del self[key]
+                if exists:
+                    del self._keys[index]
+                self._ngrams.remove(key)
+            else:
+                self[key] = value
+                if not exists:
+                    self._keys.insert(index, key)
+                self._ngrams.add(key)
+
+    def _set_memories(self, memories):
+        """
+        Sets every key and value in memories with a single storage write.
+        """
+        with self._keys_lock:
+            self.storage_set_many(memories.items())
+            self._keys = sorted(set(self._keys).union(memories))
+            for key in memories:
+                self._ngrams.add(key)
+
+    def _read_attachment(self, msg):
+        """
+        Returns the text of the first file attached to msg, or None.
+        """
+        extras = msg.extras or {}
+        files = extras.get('files') or (extras.get('slack_event') or {}).get('files') or []
+        for attachment in files:
+            url = attachment.get('url_private_download') or attachment.get('url_private')
+            if url:
+                token = (getattr(self.bot_config, 'BOT_IDENTITY', None) or {}).get('token')
+                headers = {'Authorization': 'Bearer {}'.format(token)} if token else {}
+                response = lazy_import('requests').get(url, headers=headers, timeout=30)
+                response.raise_for_status()
+                return response.text
+        return None
+
+    def _did_you_mean(self, key):
+        with self._keys_lock:
+            similar = self._ngrams.similar(key.lower())
+        if similar:
+            return '\nDid you mean: {}?'.format(', '.join('`{}`'.format(s) for s in similar))
+        return ''
 
     @re_botcmd(
         re_cmd_name_help='remember',
@@ -49,9 +216,10 @@ class Remember(BotPlugin):
         try:
             return self._get_memory(key)
         except KeyError:
-            return "I don't remember anything matching `{0}`\n " \
+            return "I don't remember anything matching `{0}`{2}\n " \
                 "You can see what I remember by typing: `{1}what do you remember`\n " \
-                "You can add a new memory by typing: `{1}remember {0} is <something>`".format(key, self._bot.prefix)
+                "You can add a new memory by typing: `{1}remember {0} is <something>`".format(
+                    key, self._bot.prefix, self._did_you_mean(key))
 
     @botcmd
     def forget(self, msg, key):
@@ -62,17 +230,104 @@ class Remember(BotPlugin):
             self._set_memory(key)
             return "I've forgotten {} is {}".format(key, value)
         except KeyError:
-            return "I don't remember anything matching `{0}`\n " \
-                "You can see what I remember by typing: `{1}what do you remember`".format(key, self._bot.prefix)
+            return "I don't remember anything matching `{0}`{2}\n " \
+                "You can see what I remember by typing: `{1}what do you remember`".format(
+                    key, self._bot.prefix, self._did_you_mean(key))
 
     @re_botcmd(
-        re_cmd_name_help='what do you remember',
-        pattern=r'^\s*(what(\s|_)+do(\s|_)+you(\s|_)+remember|memories)\s*$',
+        re_cmd_name_help='what do you remember [<prefix>] [page <number>]',
+        pattern=r'^\s*(?:what(?:\s|_)+do(?:\s|_)+you(?:\s|_)+remember|memories)(\s+.*|\s*)$',
         flags=re.IGNORECASE)
-    def what_do_you_remember(self, msg, args):
-        """Display a list of all memories"""
-        memories = self.keys()
+    def what_do_you_remember(self, msg, match):
+        """Display a page of memories, optionally only those starting with a prefix"""
+        prefix = match.group(1).strip()
+        page = 1
+        page_match = _REMEMBER_PAGE_RE.match(prefix)
+        if page_match:
+            prefix = page_match.group(1).strip()
+            page = max(1, int(page_match.group(2)))
+        prefix = prefix.lower()
+
+        with self._keys_lock:
+            start, stop = self._prefix_range(prefix)
+            pages = (stop - start + self.PAGE_SIZE - 1) // self.PAGE_SIZE
+            page = max(1, min(page, pages))
+            offset = start + (page - 1) * self.PAGE_SIZE
+            memories = self._keys[offset:min(offset + self.PAGE_SIZE, stop)]
+
         if not memories:
+            if prefix:
+                return "I don't remember anything starting with `{}`".format(prefix)
             return "I don't remember anything\n " \
                 "You can add a new memory by typing: `{0}remember <name> is <something>`".format(self._bot.prefix)
-        return '\n'.join(['I remember:'] + [s for s in sorted(memories)])
+
+        lines = ['I remember:'] + memories
+        if page < pages:
+            lines.append('Page {} of {}, type `{}what do you remember {}page {}` for more'.format(
+                page, pages, self._bot.prefix, prefix + ' ' if prefix else '', page + 1))
+        elif pages > 1:
+            lines.append('Page {} of {}'.format(page, pages))
+        return '\n'.join(lines)
+
+    @botcmd
+    def memories_export(self, msg, args):
+        """Export every memory as a file: memories export [jsonl|yaml]"""
+        export_format = args.strip().lower() or 'jsonl'
+        if export_format not in _EXPORT_FORMATS:
+            return 'Usage: `{}memories export [jsonl|yaml]`'.format(self._bot.prefix)
+
+        with self._keys_lock:
+            keys = list(self._keys)
+        if not keys:
+            return "I don't remember anything"
+
+        output = tempfile.TemporaryFile()
+        for key in keys:
+            if export_format == 'jsonl':
+                line = json.dumps({'key': key, 'value': self[key]}) + '\n'
+            else:
+                line = lazy_import('yaml').safe_dump({key: self[key]}, default_flow_style=False, allow_unicode=True)
+            output.write(line.encode('utf-8'))
+        size = output.tell()
+        output.seek(0)
+        self.send_stream_request(
+            self.message_identifier(msg), output, name='memories.{}'.format(export_format), size=size,
+            stream_type=_EXPORT_FORMATS[export_format])
+        return 'Exported {} memories'.format(len(keys))
+
+    @botcmd
+    def memories_import(self, msg, args):
+        """Import memories from an attached or pasted JSON Lines or YAML file: memories import [overwrite]"""
+        options, _, content = args.partition('\n')
+        overwrite = options.strip().lower() == 'overwrite'
+        if options.strip() and not overwrite:
+            content = args
+
+        try:
+            memories = _parse_memories(self._read_attachment(msg) or content)
+        except ValueError as ex:
+            return "I couldn't read those memories, {}".format(ex)
+        except Exception as ex:
+            return "I couldn't download the attached file: `{}`".format(ex)
+        if not memories:
+            return "Attach or paste the memories to import, as JSON Lines or YAML\n " \
+                "For example: `{}memories import` followed by lines like " \
+                "`{{\"key\": \"wifi\", \"value\": \"magfest / hunter2\"}}`".format(self._bot.prefix)
+
+        with self._keys_lock:
+            existing = {key: self[key] for key in memories if self._has_key(key)}
+        conflicts = sorted(key for key, value in existing.items() if value != memories[key])
+        if conflicts and not overwrite:
+            return "I didn't import anything, {} memor{} already different: {}{}\n " \
+                "You can replace them by typing: `{}memories import overwrite`".format(
+                    len(conflicts),
+                    'y is' if len(conflicts) == 1 else 'ies are',
+                    ', '.join('`{}`'.format(key) for key in conflicts[:10]),
+                    ', ...' if len(conflicts) > 10 else '',
+                    self._bot.prefix)
+
+        changed = OrderedDict((key, value) for key, value in memories.items() if existing.get(key) != value)
+        if changed:
+            self._set_memories(changed)
+        return "OK, I imported {} memories: {} new, {} replaced, {} unchanged".format(
+            len(memories), len(changed) - len(conflicts), len(conflicts), len(memories) - len(changed))
@@ -0,0 +1,146 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+
+from errbot.storage.base import StorageBase, StoragePluginBase
+
+
+log = logging.getLogger('errbot.storage.sqlite')
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    key_lower TEXT NOT NULL,
+    value BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS kv_key_lower ON kv (key_lower);
+CREATE TABLE IF NOT EXISTS kv_terms (
+    name TEXT NOT NULL,
+    term TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (name, term, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS kv_terms_key ON kv_terms (key);
+'''
+
+
+def _prefix_upper_bound(prefix):
+    """
+    Returns the smallest string that sorts after every string starting with prefix.
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+
+class SQLiteStorage(StorageBase):
+    """
+    Key value storage in a SQLite database, in WAL mode.
+
+    Besides the errbot storage contract, this exposes indexed lookups that
+    plugins can use when they're available:
+
+    * get_lower() finds a value by case insensitive key
+    * keys_with_prefix() and keys_in_range() list keys in sorted order
+    * keys_for_term() finds keys by an indexed term of their value. Values
+      that define an index_terms() method, returning a dict of index names
+      to terms, are indexed when they're set.
+    * set_many() sets many keys in a single transaction
+    """
+
+    def __init__(self, path):
+        log.debug('Open SQLite storage %s', path)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+
+    def _query(self, sql, *params):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _set(self, key, value):
+        self._db.execute(
+            'INSERT OR REPLACE INTO kv (key, key_lower, value) VALUES (?, ?, ?)',
+            (key, key.lower(), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+        index_terms = getattr(value, 'index_terms', None)
+        if callable(index_terms):
+            self._db.execute('DELETE FROM kv_terms WHERE key = ?', (key,))
+            self._db.executemany(
+                'INSERT OR IGNORE INTO kv_terms (name, term, key) VALUES (?, ?, ?)',
+                [(name, term, key) for name, terms in index_terms().items() for term in terms])
+
+    def get(self, key):
+        rows = self._query('SELECT value FROM kv WHERE key = ?', key)
+        if not rows:
+            raise KeyError('{} doesn\'t exist.'.format(key))
+        return pickle.loads(rows[0][0])
+
+    def get_lower(self, key):
+        rows = self._query('SELECT value FROM kv WHERE key_lower = ? ORDER BY key LIMIT 1', key.lower())
+        if not rows:
+            raise KeyError('{} doesn\'t exist.'.format(key))
+        return pickle.loads(rows[0][0])
+
+    def set(self, key, value):
+        with self._lock, self._db:
+            self._set(key, value)
+
+    def set_many(self, items):
+        with self._lock, self._db:
+            for key, value in items:
+                self._set(key, value)
+
+    def remove(self, key):
+        with self._lock, self._db:
+            if not self._db.execute('DELETE FROM kv WHERE key = ?', (key,)).rowcount:
+                raise KeyError('{} doesn\'t exist.'.format(key))
+            self._db.execute('DELETE FROM kv_terms WHERE key = ?', (key,))
+
+    def len(self):
+        return self._query('SELECT COUNT(*) FROM kv')[0][0]
+
+    def keys(self):
+        return [row[0] for row in self._query('SELECT key FROM kv ORDER BY key')]
+
+    def keys_in_range(self, start=None, stop=None, limit=-1, offset=0):
+        """
+        Returns the sorted keys where start <= key < stop.
+        """
+        sql = 'SELECT key FROM kv WHERE key >= ?'
+        params = [start or '']
+        if stop is not None:
+            sql += ' AND key < ?'
+            params.append(stop)
+        sql += ' ORDER BY key LIMIT ? OFFSET ?'
+        return [row[0] for row in self._query(sql, *(params + [limit, offset]))]
+
+    def keys_with_prefix(self, prefix, limit=-1, offset=0):
+        return self.keys_in_range(prefix, _prefix_upper_bound(prefix), limit, offset)
+
+    def count_with_prefix(self, prefix):
+        stop = _prefix_upper_bound(prefix)
+        if stop is None:
+            return self.len()
+        return self._query('SELECT COUNT(*) FROM kv WHERE key >= ? AND key < ?', prefix, stop)[0][0]
+
+    def keys_for_term(self, name, term):
+        return [row[0] for row in self._query(
+            'SELECT key FROM kv_terms WHERE name = ? AND term = ? ORDER BY key', name, term)]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+            self._db = None
+
+
+class SQLiteStoragePlugin(StoragePluginBase):
+    def __init__(self, bot_config):
+        super().__init__(bot_config)
+        if 'basedir' not in self._storage_config:
+            self._storage_config['basedir'] = bot_config.BOT_DATA_DIR
+
+    def open(self, namespace):
+        return SQLiteStorage(os.path.join(self._storage_config['basedir'], namespace + '.sqlite'))
@@ -3,4 +3,5 @@ from os.path import dirname, join, realpath
 
 
 sys.path.append(join(dirname(dirname(realpath(__file__))), 'plugins'))  # noqa: E402
+sys.path.append(join(dirname(dirname(realpath(__file__))), 'storage'))  # noqa: E402
 pytest_plugins = ['errbot.backends.test']
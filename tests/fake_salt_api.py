@@ -0,0 +1,241 @@
+"""
+A local stand-in for the rest_cherrypy Salt API.
+
+Serves the endpoints magbot uses, /login and the local, local_async and
+runner jobs.lookup_jid and cache.grains clients of /, for a fleet of fake
+reggie minions.
+Every minion returns an async job after a random latency, and fails it at
+a configurable rate, so Salt commands can be tested and benchmarked
+without a salt master.
+"""
+import asyncio
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from fnmatch import fnmatchcase
+
+from aiohttp import web
+
+
+ENVS = ['prod', 'staging', 'load', 'dev', 'onsite']
+EVENT_NAMES = ['super', 'labs', 'stock', 'west']
+
+
+class FakeJob(object):
+    def __init__(self, jid, fun, minions, started, latencies, failures, states):
+        self.jid = jid
+        self.fun = fun
+        self.minions = minions
+        self.started = started
+        self.latencies = latencies
+        self.failures = failures
+        self.states = states
+
+    def returned(self, now):
+        """
+        Returns the states of every minion that has returned by now.
+        """
+        elapsed = now - self.started
+        return {m: self.minion_states(m) for m in self.minions if self.latencies[m] <= elapsed}
+
+    def minion_states(self, minion):
+        states = OrderedDict()
+        for i in range(self.states):
+            failed = self.failures[minion] and i == self.states - 1
+            name = 'file_|-reggie_config_{0}_|-/srv/reggie/config/{0}.ini_|-managed'.format(i)
+            states[name] = {
+                '__id__': 'reggie_config_{}'.format(i),
+                '__sls__': 'reggie.config',
+                'name': '/srv/reggie/config/{}.ini'.format(i),
+                'result': not failed,
+                'comment': 'Unable to manage file' if failed else 'File is in the correct state',
+                'changes': {'diff': 'New file'} if i == 0 else {},
+                'duration': 10.0 + i,
+            }
+        return states
+
+
+class FakeSaltAPI(object):
+    """
+    A fake Salt API serving minions reggie-0000 to reggie-NNNN, spread
+    evenly across ENVS and EVENT_NAMES, plus mcp.magfest.net.
+
+    Minions return async jobs after a latency picked uniformly from the
+    latency range in seconds, and fail one state of the job with
+    probability failure_rate. Minions that never return can be simulated
+    with a latency range longer than the job's polls, or by adding them to
+    offline, which also keeps them out of local jobs like test.ping. Offline
+    minions stay in the master's grain cache.
+
+    The server listens as soon as it's created, so its url can go in the
+    bot config, but only answers requests once it's started. Every request
+    is counted in calls, by client and function.
+    """
+
+    def __init__(self, minions=20, latency=(0, 0.2), failure_rate=0, states=5, seed=0, host='127.0.0.1'):
+        self._socket = socket.socket()
+        self._socket.bind((host, 0))
+        self._socket.listen(128)
+        self.url = 'http://{}:{}'.format(*self._socket.getsockname())
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self.tokens = set()
+        self.reset(minions, latency, failure_rate, states, seed)
+
+    def reset(self, minions=20, latency=(0, 0.2), failure_rate=0, states=5, seed=0):
+        """
+        Replaces the fleet of fake minions, and forgets every job and call.
+        Auth tokens stay valid.
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.states = states
+        self.random = random.Random(seed)
+        self.grains = OrderedDict()
+        for i in range(minions):
+            self.grains['reggie-{:04}'.format(i)] = {
+                'roles': ['reggie'],
+                'env': ENVS[i % len(ENVS)],
+                'event_name': EVENT_NAMES[i // len(ENVS) % len(EVENT_NAMES)],
+                'event_year': 2018 + i % 3,
+            }
+        self.grains['mcp.magfest.net'] = {'roles': ['mcp'], 'env': 'prod'}
+        self.offline = set()
+        self.jobs = OrderedDict()
+        self.calls = Counter()
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post('/login', self._login)
+        app.router.add_post('/', self._lowstate)
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        self._loop.run_until_complete(web.SockSite(self._runner, self._socket).start())
+        self._thread = threading.Thread(target=self._loop.run_forever, name='Fake Salt API', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+        self._loop.close()
+
+    def match(self, tgt, expr_form='glob'):
+        """
+        Returns the sorted minion ids matched by tgt.
+
+        Targets are matched the way the salt master matches them, without
+        magbot's MinionCache, so tests catch any difference between the two.
+        """
+        if expr_form == 'compound':
+            return sorted(m for m in self.grains if self._match_compound(m, tgt))
+        elif expr_form == 'list':
+            return sorted(set(tgt.split(',')).intersection(self.grains))
+        return sorted(m for m in self.grains if fnmatchcase(m, tgt))
+
+    def _match_compound(self, minion, tgt):
+        """
+        Like salt's compound matcher, evaluates each word of tgt against the
+        minion, and the resulting boolean expression as Python. Anything
+        invalid matches nothing.
+        """
+        words = []
+        for word in tgt.replace('(', ' ( ').replace(')', ' ) ').split():
+            if word in ('and', 'or', 'not', '(', ')'):
+                words.append(word)
+            else:
+                words.append(str(self._match_word(minion, word)))
+        try:
+            return eval(' '.join(words))
+        except SyntaxError:
+            return False
+
+    def _match_word(self, minion, word):
+        engine, expression = word.split('@', 1) if word[1:2] == '@' else ('', word)
+        try:
+            if engine == '':
+                return fnmatchcase(minion, expression)
+            elif engine == 'L':
+                return minion in expression.split(',')
+            elif engine == 'E':
+                return bool(re.match(expression, minion))
+            elif engine in ('G', 'P'):
+                # Grain values and patterns are both lowercased
+                grain, _, pattern = expression.partition(':')
+                values = self.grains[minion].get(grain)
+                values = values if isinstance(values, list) else [values]
+                for value in values:
+                    if value is None:
+                        continue
+                    value, pattern = str(value).lower(), pattern.lower()
+                    if re.match(pattern, value) if engine == 'P' else fnmatchcase(value, pattern):
+                        return True
+                return False
+        except re.error:
+            return False
+        return False
+
+    async def _login(self, request):
+        self.calls['login'] += 1
+        token = uuid.uuid4().hex
+        self.tokens.add(token)
+        data = await request.json()
+        return web.json_response({'return': [{
+            'token': token,
+            'user': data.get('username'),
+            'eauth': data.get('eauth'),
+            'perms': [{'*': ['.*']}],
+            'start': time.time(),
+            'expire': time.time() + 12 * 60 * 60,
+        }]})
+
+    async def _lowstate(self, request):
+        if request.headers.get('X-Auth-Token') not in self.tokens:
+            return web.Response(status=401)
+
+        results = []
+        for low in await request.json():
+            self.calls['{client}:{fun}'.format(**low)] += 1
+            handler = getattr(self, '_client_{}'.format(low['client']), None)
+            if handler is None:
+                return web.Response(status=500)
+            results.append(handler(**low))
+        return web.json_response({'return': results})
+
+    def _client_local(self, tgt, fun, arg=None, expr_form='glob', **kwargs):
+        minions = [m for m in self.match(tgt, expr_form) if m not in self.offline]
+        if fun == 'grains.item':
+            return {m: {g: self.grains[m].get(g) for g in arg or []} for m in minions}
+        elif fun == 'network.ip_addrs':
+            return {m: ['10.10.0.{}'.format(i % 250), '192.168.0.{}'.format(i % 250)] for i, m in enumerate(minions)}
+        return {m: True for m in minions}
+
+    def _client_local_async(self, tgt, fun, expr_form='glob', **kwargs):
+        minions = self.match(tgt, expr_form)
+        if not minions:
+            return {}
+        jid = time.strftime('%Y%m%d%H%M%S') + '{:06}'.format(len(self.jobs))
+        self.jobs[jid] = FakeJob(
+            jid,
+            fun,
+            minions,
+            time.monotonic(),
+            {m: float('inf') if m in self.offline else self.random.uniform(*self.latency) for m in minions},
+            {m: self.random.random() < self.failure_rate for m in minions},
+            self.states)
+        return {'jid': jid, 'minions': minions}
+
+    def _client_runner(self, fun, jid=None, tgt='*', tgt_type='glob', **kwargs):
+        if fun == 'cache.grains':
+            return {m: self.grains[m] for m in self.match(tgt, tgt_type)}
+        elif fun != 'jobs.lookup_jid':
+            return {}
+        job = self.jobs.get(jid)
+        return job.returned(time.monotonic()) if job else {}
@@ -0,0 +1,24 @@
+import diagnostics  # noqa: F401
+
+
+extra_plugin_dir = 'plugins'
+
+
+def test_diagnostics(testbot):
+    testbot.assertCommand('!startup times', 'Links')
+    testbot.assertCommand('!startup times', 'Diagnostics')
+    testbot.assertCommand('!startup times', 'Remember')
+    testbot.assertCommand('!profile', 'Usage: !profile <command ...>')
+    testbot.assertCommand('!profile not a command', "I don't know the command not a command")
+
+    testbot.push_message('!profile !startup times')
+    reply = testbot.pop_message()
+    assert 'Profiled startup times' in reply
+    assert '1 reply, 0 messages sent' in reply
+    assert 'startup_times (diagnostics.py' in reply
+    assert testbot.pop_message()
+
+    testbot.assertCommand('!links add foo http://example.com', "Okay, I'll reply with that link")
+    testbot.push_message('!profile links')
+    assert '0 replies, 1 message sent' in testbot.pop_message()
+    assert testbot.pop_message()
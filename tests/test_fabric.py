@@ -0,0 +1,99 @@
+import logging
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import fabric
+import pytest
+
+from magbot_fabric import FabricMixin
+
+
+class FakeConnection(object):
+    opened = []
+
+    def __init__(self, host, user, config, connect_kwargs):
+        FakeConnection.opened.append(self)
+        self.host = host
+        self.user = user
+        self.is_connected = False
+        self.closed = False
+        self.transport = Mock()
+
+    def open(self):
+        self.is_connected = True
+
+    def close(self):
+        self.is_connected = False
+        self.closed = True
+
+    def run(self, command, **kwargs):
+        return command
+
+    def sudo(self, command, **kwargs):
+        return command
+
+
+class _Plugin(object):
+    log = logging.getLogger('errbot.plugins.test_fabric')
+
+    def activate(self):
+        pass
+
+    def deactivate(self):
+        pass
+
+
+class FabricPlugin(FabricMixin, _Plugin):
+    def __init__(self):
+        self.bot_config = SimpleNamespace(
+            SSH_HOST='salt-master.example.com', SSH_USERNAME='magbot', SSH_PASSWORD='', SSH_KEY=None)
+        super().__init__()
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    monkeypatch.setattr(fabric, 'Connection', FakeConnection)
+    monkeypatch.setattr(FakeConnection, 'opened', [])
+    return FakeConnection.opened
+
+
+@pytest.fixture
+def plugin():
+    plugin = FabricPlugin()
+    plugin.activate()
+    return plugin
+
+
+def test_connection_reused(plugin, connections):
+    with plugin.FabricConnection() as c:
+        c.sudo('git -C /srv/infrastructure pull')
+    with plugin.FabricConnection() as c:
+        c.sudo('salt-run fileserver.update')
+
+    assert len(connections) == 1
+    assert connections[0].host == 'salt-master.example.com'
+    connections[0].transport.set_keepalive.assert_called_once_with(30)
+
+
+def test_connection_reconnects(plugin, connections):
+    with plugin.FabricConnection():
+        pass
+    connections[0].is_connected = False
+    with plugin.FabricConnection() as c:
+        assert c is connections[1]
+    assert connections[0].closed
+
+    with pytest.raises(EOFError):
+        with plugin.FabricConnection():
+            raise EOFError()
+    assert connections[1].closed
+    with plugin.FabricConnection() as c:
+        assert c is connections[2]
+
+
+def test_connection_closed_on_deactivate(plugin, connections):
+    with plugin.FabricConnection():
+        pass
+    plugin.deactivate()
+    assert connections[0].closed
+    assert plugin._fabric_connection is None
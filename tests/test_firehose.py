@@ -0,0 +1,210 @@
+"""
+Message firehose load test.
+
+Replays a multi-channel stream of chat messages through every loaded
+plugin, the same way a chat backend delivers them: one at a time, from a
+single thread. Reports throughput, how long messages waited to be
+processed, and the CPU time each plugin's callback_message used.
+
+Skipped unless MAGBOT_FIREHOSE is set. Configure with:
+
+* MAGBOT_FIREHOSE_RATE: messages per second to send, 0 to send them as
+  fast as possible (default 500)
+* MAGBOT_FIREHOSE_COUNT: messages to send (default 5000)
+* MAGBOT_FIREHOSE_BASELINE: a JSON file to compare throughput against, if
+  it exists
+* MAGBOT_FIREHOSE_TOLERANCE: fraction below the baseline throughput that's
+  still a pass (default 0.2)
+* MAGBOT_FIREHOSE_RECORD: write the measured throughput to the baseline file
+
+Throughput depends on the machine, so no baseline is committed. Record one
+on a branch, then run the test on the same machine to compare against it.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from queue import Empty, Queue
+
+import pytest
+from errbot.backends.base import Message
+from errbot.backends.test import TestOccupant, TestRoom
+
+import links  # noqa: F401
+
+
+extra_plugin_dir = 'plugins'
+extra_config = {
+    'OUTBOUND_RATE': 10000,
+    'OUTBOUND_BURST': 10000,
+    'SALT_MINION_CACHE_INTERVAL': 0,
+}
+loglevel = logging.WARNING
+
+pytestmark = pytest.mark.skipif(not os.environ.get('MAGBOT_FIREHOSE'), reason='set MAGBOT_FIREHOSE to run')
+
+_thread_time = getattr(time, 'thread_time', time.process_time)
+
+_WORDS = (
+    'the a to is it that and of you in for on this we have be are with can do at anyone know '
+    'registration badge panel hotel room shuttle volunteer shift dealer arcade console lan music '
+    'stage schedule staff tonight tomorrow morning setup teardown radio channel ops security '
+    'lost found wifi password printer ticket laptop cable power strip table chairs load dock'
+).split()
+
+_TRIGGERS = [
+    ('hotel lottery', 'https://magfest.org/hotels'),
+    ('volunteer checklist', 'https://magfest.org/volunteer'),
+    ('/shuttle\\s+schedule/i', 'https://magfest.org/shuttle'),
+    ('lost and found', 'https://magfest.org/lost'),
+    ('/(wifi|wi-fi)\\s+password/i', 'https://magfest.org/wifi'),
+    ('dealer load in', 'https://magfest.org/dealers'),
+    ('panel schedule', 'https://magfest.org/panels'),
+    ('tech ops radio', 'https://magfest.org/radio'),
+]
+
+
+def _message_stream(bot, count, channels=20, users=200, trigger_rate=0.05, seed=1337):
+    """
+    Builds count messages spread across channels and users, where about
+    trigger_rate of them mention a links trigger phrase.
+    """
+    rng = random.Random(seed)
+    rooms = [TestRoom('#channel-{}'.format(i), bot=bot) for i in range(channels)]
+    phrases = [t.strip('/i').replace('\\s+', ' ').replace('(wifi|wi-fi)', 'wifi') for t, _ in _TRIGGERS]
+    messages = []
+    for _ in range(count):
+        room = rooms[min(int(rng.paretovariate(1.2)) - 1, channels - 1)]
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(2, 30))]
+        if rng.random() < trigger_rate:
+            words.insert(rng.randint(0, len(words)), rng.choice(phrases))
+        msg = Message(' '.join(words))
+        msg.frm = TestOccupant('user{}'.format(rng.randrange(users)), room)
+        msg.to = room
+        messages.append(msg)
+    return messages
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+def _time_callbacks(plugins, cpu_times):
+    """
+    Wraps the callback_message of each plugin to add up the CPU time it uses.
+    """
+    for plugin in plugins:
+        callback = plugin.callback_message
+
+        def timed_callback(msg, callback=callback, name=plugin.name):
+            started = _thread_time()
+            try:
+                return callback(msg)
+            finally:
+                cpu_times[name] = cpu_times.get(name, 0) + _thread_time() - started
+        plugin.callback_message = timed_callback
+
+
+def _firehose(bot, messages, rate):
+    """
+    Sends messages at rate messages per second from one thread, while they're
+    processed by another. Returns the queueing delay of each message and the
+    seconds it took to process them all.
+    """
+    incoming = Queue()
+    delays = []
+
+    def receive():
+        while True:
+            scheduled, msg = incoming.get()
+            if msg is None:
+                return
+            delays.append(time.monotonic() - scheduled)
+            bot.callback_message(msg)
+
+    receiver = threading.Thread(target=receive, name='Firehose receiver')
+    receiver.start()
+    started = time.monotonic()
+    for index, msg in enumerate(messages):
+        scheduled = started + index / rate if rate else time.monotonic()
+        wait = scheduled - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        incoming.put((scheduled, msg))
+    incoming.put((None, None))
+    receiver.join()
+    return delays, time.monotonic() - started
+
+
+def _drain_replies(bot, timeout=1):
+    """
+    Pops the replies sent during the firehose, until none arrive for timeout
+    seconds, so they aren't left in the test backend's outgoing queue.
+    """
+    replies = 0
+    while True:
+        try:
+            bot.pop_message(timeout=timeout)
+        except Empty:
+            return replies
+        replies += 1
+
+
+def test_firehose(testbot, capsys):
+    rate = float(os.environ.get('MAGBOT_FIREHOSE_RATE', 500))
+    count = int(os.environ.get('MAGBOT_FIREHOSE_COUNT', 5000))
+    tolerance = float(os.environ.get('MAGBOT_FIREHOSE_TOLERANCE', 0.2))
+    baseline_file = os.environ.get('MAGBOT_FIREHOSE_BASELINE')
+
+    for trigger, link in _TRIGGERS:
+        testbot.assertCommand('!links add {} {}'.format(trigger, link), "Okay, I'll reply with that link")
+
+    bot = testbot.bot
+    cpu_times = {}
+    _time_callbacks(bot.plugin_manager.get_all_active_plugins(), cpu_times)
+    messages = _message_stream(bot, count)
+
+    root_logger = logging.getLogger()
+    root_level = root_logger.level
+    root_logger.setLevel(logging.WARNING)
+    try:
+        delays, elapsed = _firehose(bot, messages, rate)
+    finally:
+        root_logger.setLevel(root_level)
+    replies = _drain_replies(bot)
+
+    throughput = count / elapsed
+    lines = [
+        'Firehose: {} messages at {}'.format(count, '{:.0f}/s'.format(rate) if rate else 'full speed'),
+        '  throughput     {:>10.1f} messages/s'.format(throughput),
+        '  delay p50      {:>10.2f} ms'.format(_percentile(delays, 0.5) * 1000),
+        '  delay p95      {:>10.2f} ms'.format(_percentile(delays, 0.95) * 1000),
+        '  delay max      {:>10.2f} ms'.format(max(delays) * 1000),
+        '  replies        {:>10}'.format(replies),
+        '  {:<24} {:>10} {:>14}'.format('plugin', 'cpu', 'per message'),
+    ]
+    for name, seconds in sorted(cpu_times.items(), key=lambda i: i[1], reverse=True):
+        lines.append('  {:<24} {:>9.3f}s {:>12.1f}us'.format(name, seconds, seconds / count * 1e6))
+    with capsys.disabled():
+        print('\n' + '\n'.join(lines))
+
+    assert replies
+    if not baseline_file:
+        return
+    elif os.environ.get('MAGBOT_FIREHOSE_RECORD'):
+        with open(baseline_file, 'w') as f:
+            json.dump({'rate': rate, 'count': count, 'throughput': round(throughput, 1)}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return
+    elif not os.path.exists(baseline_file):
+        return
+
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    # A throttled run can't go faster than its rate, so compare against that
+    expected = min(baseline['throughput'], rate) if rate else baseline['throughput']
+    assert throughput >= expected * (1 - tolerance), \
+        'Throughput {:.1f}/s fell below the baseline of {:.1f}/s'.format(throughput, expected)
@@ -1,7 +1,14 @@
+from queue import Empty
+
+import pytest
+from errbot.backends.base import Message
+from errbot.backends.test import TestOccupant, TestRoom
+
 import links  # noqa: F401
 
 
 extra_plugin_dir = 'plugins'
+extra_config = {'LINKS_COOLDOWN': 0}
 
 
 def test_remember(testbot):
@@ -32,3 +39,38 @@ def test_remember(testbot):
     testbot.assertCommand('!links', 'http://asdf.com')
     testbot.assertCommand('!links remove SIMPLE   PHRASE', "Removed")
     testbot.assertCommand('!links', "I don't know any trigger phrases")
+
+
+def test_match_cache(testbot):
+    testbot.push_message('cached phrase')
+    testbot.push_message('!links add cached phrase http://example.com')
+    assert "Okay, I'll reply with that link" in testbot.pop_message()
+    testbot.assertCommand('cached phrase', 'http://example.com')
+    testbot.assertCommand('!links remove cached phrase', 'Removed')
+    testbot.push_message('cached phrase')
+    testbot.assertCommand('!links', "I don't know any trigger phrases")
+
+
+def _room_message(bot, room, text):
+    msg = Message(text)
+    msg.frm = TestOccupant('user', TestRoom(room, bot=bot))
+    msg.to = msg.frm.room
+    return msg
+
+
+class TestCooldown(object):
+    extra_config = {'LINKS_COOLDOWN': 60}
+
+    def test_cooldown(self, testbot):
+        testbot.assertCommand('!links add simple phrase http://example.com', "Okay, I'll reply with that link")
+        testbot.assertCommand('!links add other phrase http://asdf.com', "Okay, I'll reply with that link")
+
+        testbot.bot.callback_message(_room_message(testbot.bot, '#general', 'simple phrase'))
+        assert testbot.pop_message() == 'http://example.com'
+        testbot.bot.callback_message(_room_message(testbot.bot, '#general', 'a simple phrase'))
+        testbot.bot.callback_message(_room_message(testbot.bot, '#general', 'other phrase'))
+        assert testbot.pop_message() == 'http://asdf.com'
+        testbot.bot.callback_message(_room_message(testbot.bot, '#random', 'simple phrase'))
+        assert testbot.pop_message() == 'http://example.com'
+        with pytest.raises(Empty):
+            testbot.pop_message(timeout=0.5)
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from magbot import OutboundQueue, _Outbound
+
+
+def test_outbound_queue():
+    sent = []
+    done = threading.Event()
+
+    def send(text=None, **kwargs):
+        sent.append((time.monotonic(), text or kwargs['title']))
+        if len(sent) == 4:
+            done.set()
+
+    queue = OutboundQueue(rate=20, burst=1)
+    with queue._condition:
+        queue.put('#general', OutboundQueue.BACKGROUND, send, title='Success')
+        queue.put('#general', OutboundQueue.REPLY, send, 'one', in_reply_to=None)
+        queue.put('#general', OutboundQueue.REPLY, send, 'two', in_reply_to=None)
+        queue.put('#general', OutboundQueue.REPLY, send, 'x' * 1000, in_reply_to=None)
+        queue.put('#random', OutboundQueue.BACKGROUND, send, 'elsewhere', in_reply_to=None)
+
+    assert done.wait(5)
+    assert [text for _, text in sent] == ['one \n two', 'elsewhere', 'x' * 1000, 'Success']
+    assert sent[3][0] - sent[0][0] >= 2 / 20
+
+
+def test_outbound_queue_on_sent():
+    timings = []
+    done = threading.Event()
+
+    def on_sent(started, waited, duration):
+        timings.append((waited, duration))
+        if len(timings) == 2:
+            done.set()
+
+    queue = OutboundQueue(rate=20, burst=1)
+    with queue._condition:
+        queue.put('#general', OutboundQueue.REPLY, lambda **kwargs: time.sleep(0.05), 'one', on_sent)
+        queue.put('#general', OutboundQueue.REPLY, lambda **kwargs: None, 'two', on_sent)
+
+    assert done.wait(5)
+    # Both were merged into one message, and sent together
+    assert len(timings) == 2
+    assert all(duration >= 0.05 for _, duration in timings)
+
+
+def test_outbound_queue_prunes_channels():
+    done = threading.Event()
+    queue = OutboundQueue(rate=2, burst=1)
+    queue.put('#general', OutboundQueue.REPLY, lambda **kwargs: done.set(), 'one')
+    assert done.wait(5)
+
+    # Kept until its bucket refills
+    with queue._condition:
+        queue._next()
+        assert '#general' in queue._channels
+    time.sleep(0.6)
+    with queue._condition:
+        assert queue._next() == (None, None)
+        assert not queue._channels
+
+
+def _slack_markdown_converter():
+    try:
+        from errbot.backends.slack import slack_markdown_converter
+    except ImportError:
+        slack_markdown_converter = pytest.importorskip('slackv3.markdown').slack_markdown_converter
+    return slack_markdown_converter()
+
+
+def test_merged_markdown():
+    send = None
+    outbound = _Outbound(OutboundQueue.BACKGROUND, 0, send, '**Rolling out** to 4 servers', in_reply_to=None)
+    assert outbound.merge(_Outbound(OutboundQueue.BACKGROUND, 1, send, '**Starting wave** 1/4', in_reply_to=None), 1000)
+    lines = _slack_markdown_converter().convert(outbound.text).splitlines()
+    assert [line.strip() for line in lines] == ['*Rolling out* to 4 servers', '*Starting wave* 1/4']
@@ -14,3 +14,46 @@ def test_remember(testbot):
     testbot.assertCommand('!what do you remember', 'I remember:\ntest key')
     testbot.assertCommand('!forget Test Key', "I've forgotten Test Key is Test Value")
     testbot.assertCommand('!what do you remember', "I don't remember anything")
+
+    for i in range(45):
+        testbot.assertCommand('!remember wifi {0:02} is password{0}'.format(i), 'remember wifi {:02}'.format(i))
+    testbot.assertCommand('!remember radio is channel 4', "OK, I'll remember radio")
+    testbot.assertCommand('!what do you remember', 'I remember:\nradio\nwifi 00\n')
+    testbot.assertCommand('!what do you remember', 'Page 1 of 2, type !what do you remember page 2 for more')
+    testbot.assertCommand('!what do you remember page 2', 'I remember:\nwifi 39\nwifi 40')
+    testbot.assertCommand('!what do you remember WIFI page 2', 'I remember:\nwifi 40\nwifi 41')
+    testbot.assertCommand('!what do you remember wifi', 'type !what do you remember wifi page 2 for more')
+    testbot.assertCommand('!what do you remember wifi page 9', 'wifi 44\nPage 2 of 2')
+    testbot.assertCommand('!what do you remember ra', 'I remember:\nradio')
+    testbot.assertCommand('!what do you remember tv', "I don't remember anything starting with tv")
+    testbot.assertCommand('!what do you remember zebra', "I don't remember anything starting with zebra")
+    testbot.assertCommand('!what do you remember zebra page 3', "I don't remember anything starting with zebra")
+
+    testbot.assertCommand('!remember wifi password is hunter2', "OK, I'll remember wifi password")
+    testbot.assertCommand('!remember wifi pasword', 'Did you mean: wifi password, ')
+    testbot.assertCommand('!forget wifi pasword', 'Did you mean: wifi password, ')
+    testbot.assertCommand('!forget xyzzy', "I don't remember anything matching xyzzy\n")
+
+    testbot.push_message('!memories export')
+    export = testbot.pop_message()
+    assert b'{"key": "radio", "value": "channel 4"}\n' in export
+    assert 'Exported 47 memories' in testbot.pop_message()
+    testbot.push_message('!memories export yaml')
+    assert b'radio: channel 4\n' in testbot.pop_message()
+    assert 'Exported 47 memories' in testbot.pop_message()
+
+    testbot.assertCommand('!remember import deadline is friday', "OK, I'll remember import deadline")
+    testbot.assertCommand('!remember import deadline', 'friday')
+    testbot.assertCommand('!forget import deadline', 'import deadline')
+    testbot.assertCommand('!memories import', 'Attach or paste the memories to import')
+    testbot.assertCommand('!memories import\n{"key": "radio"}', "I couldn't read those memories, line 1")
+    testbot.assertCommand(
+        '!memories import\n{"key": "Radio", "value": "channel 5"}\n{"key": "dock", "value": "B"}',
+        "I didn't import anything, 1 memory is already different: radio")
+    testbot.assertCommand('!remember dock', "I don't remember anything matching dock")
+    testbot.assertCommand(
+        '!memories import overwrite\n```\nradio: channel 5\ndock: B\nwifi 00: password0\n```',
+        'OK, I imported 3 memories: 1 new, 1 replaced, 1 unchanged')
+    testbot.assertCommand('!remember dock', 'B')
+    testbot.assertCommand('!remember radio', 'channel 5')
+    testbot.assertCommand('!what do you remember d', 'I remember:\ndock')
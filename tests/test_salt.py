@@ -0,0 +1,593 @@
+"""
+Salt command tests, against the fake Salt API in fake_salt_api.
+
+The benchmark is skipped unless MAGBOT_SALT_BENCHMARK is set. It runs
+deploys against a large fleet, and reports their end to end latency, the
+Salt API calls each one made, and the CPU time spent in async_cmd_poller()
+and _format_results(). Configure with:
+
+* MAGBOT_SALT_BENCHMARK_MINIONS: minions in the fleet (default 2500)
+* MAGBOT_SALT_BENCHMARK_JOBS: deploys to run, one after another (default 3)
+* MAGBOT_SALT_BENCHMARK_LATENCY: most seconds a minion takes to return (default 5)
+* MAGBOT_SALT_BENCHMARK_FAILURE_RATE: fraction of minions that fail (default 0.01)
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from queue import Empty
+from types import SimpleNamespace
+
+import pytest
+
+from magbot_salt import JobState, JobStats, MinionCache, PerfStats, dump_yaml, percentile
+
+from .fake_salt_api import FakeSaltAPI
+
+
+fake_salt = FakeSaltAPI()
+
+extra_plugin_dir = 'plugins'
+extra_config = {
+    'SALT_API_URL': fake_salt.url,
+    'SALT_USERNAME': 'magbot',
+    'SALT_PASSWORD': 'password',
+    'SALT_AUTH': 'pam',
+    'SALT_POLL_INTERVAL': 0.05,
+    'SALT_RESULTS_UPLOAD': False,
+    'SSH_HOST': 'salt-master.example.com',
+    'SSH_USERNAME': 'magbot',
+    'SSH_PASSWORD': '',
+    'SSH_KEY': None,
+    'OUTBOUND_RATE': 10000,
+    'OUTBOUND_BURST': 10000,
+}
+loglevel = logging.WARNING
+
+_thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def salt_api():
+    fake_salt.start()
+    yield fake_salt
+    fake_salt.stop()
+
+
+def _infrastructure(testbot, **fleet):
+    """
+    Resets the fake fleet, and returns the Infrastructure plugin with its
+    minion cache refreshed, and the infrastructure repo sync stubbed out.
+    """
+    fake_salt.reset(**fleet)
+    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('Infrastructure')
+    plugin.repo_syncs = 0
+
+    def update_infrastructure_repo():
+        plugin.repo_syncs += 1
+        time.sleep(0.1)
+        return 'c0ffee'
+    plugin._update_infrastructure_repo = update_infrastructure_repo
+    plugin._salt_loop.submit(plugin._refresh_minion_cache()).result(10)
+    fake_salt.calls.clear()
+    return plugin
+
+
+def _pop_until(testbot, text, timeout=10):
+    """
+    Returns every message sent until one containing text.
+    """
+    messages = []
+    deadline = time.monotonic() + timeout
+    while not messages or text not in messages[-1]:
+        try:
+            messages.append(testbot.pop_message(timeout=max(0, deadline - time.monotonic())))
+        except Empty:
+            pytest.fail('Timed out waiting for {!r}, got {!r}'.format(text, messages))
+    return messages
+
+
+def test_ping(testbot):
+    _infrastructure(testbot, minions=10)
+    testbot.push_message('!ping prod')
+    reply = testbot.pop_message()
+    assert 'reggie-0000: true' in reply
+    assert 'reggie-0005: true' in reply
+    assert 'reggie-0001' not in reply
+    assert fake_salt.calls == Counter({'local:test.ping': 1})
+
+
+def test_deploy(testbot):
+    plugin = _infrastructure(testbot, minions=20, failure_rate=0.25, seed=3)
+    testbot.push_message('!deploy staging')
+    messages = _pop_until(testbot, 'Finished job')
+
+    jid, job = next(iter(fake_salt.jobs.items()))
+    assert job.minions == ['reggie-0001', 'reggie-0006', 'reggie-0011', 'reggie-0016']
+    assert 'Deploying latest reggie to staging' in messages[0]
+    assert 'Started job: {}/molten/job/{}'.format(fake_salt.url, jid) in messages[1]
+
+    failed = sorted(m for m in job.minions if job.failures[m])
+    assert failed
+    text = '\n'.join(messages)
+    assert text.count('Unable to manage file') == len(failed)
+    for minion in job.minions:
+        assert minion in text
+    assert fake_salt.calls['local_async:state.apply'] == 1
+    assert 1 <= fake_salt.calls['runner:jobs.lookup_jid'] <= 20
+    assert {'send', 'send_wait'}.issubset(plugin.perf.histograms)
+    assert 'send_wait' in plugin.perf.report(jid)
+
+    testbot.push_message('!salt slowest staging')
+    reply = testbot.pop_message()
+    assert 'reggie-0016' in reply
+    assert 'only as precise as the 0.05s poll interval' in reply
+
+
+def test_dump_yaml():
+    assert dump_yaml({'b': 2, 'a': 1}) == ('a: 1\nb: 2\n', 0)
+    assert dump_yaml({'a': 1, 'b': 'x' * 100}, max_length=20) == ('a: 1\n', 1)
+    # A first line that's too long is cut off rather than dropped
+    assert dump_yaml({'a': 'x' * 100}, max_length=20) == ('a: {}\n'.format('x' * 16), 1)
+
+
+def test_format_omitted(testbot):
+    plugin = _infrastructure(testbot)
+    assert plugin._format_omitted('a: 1\n', 0) == 'a: 1\n'
+    assert plugin._format_omitted('a: 1\n', 2) == 'a: 1\n... 2 more not shown'
+    assert plugin._format_omitted('a: 1\n', 2, uploading=True) == \
+        'a: 1\n... 2 more not shown, uploading full results'
+
+
+def test_format_failure(testbot):
+    plugin = _infrastructure(testbot)
+    states = [{
+        '__id__': 'requisite_{}'.format(i),
+        '__sls__': 'reggie',
+        'result': False,
+        'comment': 'One or more requisite failed',
+        'changes': {},
+    } for i in range(300)]
+    body, truncated = plugin._format_failure('reggie-0000', states, uploading=True)
+    assert truncated
+    assert len(body) <= plugin.results_max_length
+    shown = body.count('*ID*')
+    assert 0 < shown < 300
+    assert body.endswith('... {} more failed states not shown, uploading full results'.format(300 - shown))
+
+    state = {'__id__': 'reggie_venv', 'result': False, 'comment': 'x' * 200000, 'changes': {'stdout': 'y' * 200000}}
+    body, truncated = plugin._format_failure('reggie-0000', [state])
+    assert truncated
+    assert len(body) <= plugin.results_max_length
+    assert 'more characters not shown' in body
+    assert 'uploading' not in body
+
+    state['comment'] = 'Command failed'
+    state['changes'] = {'retcode': 1}
+    body, truncated = plugin._format_failure('reggie-0000', [state])
+    assert not truncated
+    assert '*Comment*: Command failed' in body
+    assert 'retcode: 1' in body
+
+
+def _record_uploads(plugin):
+    uploads = []
+
+    def send_stream_request(identifier, stream, name, size, stream_type):
+        uploads.append((name, stream.read().decode('utf-8')))
+    plugin.send_stream_request = send_stream_request
+    return uploads
+
+
+def test_upload_results(testbot):
+    plugin = _infrastructure(testbot, minions=20)
+    plugin.results_max_length = 30
+    plugin.results_upload = True
+    uploads = _record_uploads(plugin)
+    testbot.push_message('!ping prod')
+    assert testbot.pop_message() == 'reggie-0000: true\n... 3 more not shown, uploading full results'
+    # The upload starts once the reply is queued
+    deadline = time.monotonic() + 10
+    while not uploads and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert uploads == [('ping.yaml', 'reggie-0000: true\nreggie-0005: true\nreggie-0010: true\nreggie-0015: true\n')]
+
+
+def test_upload_failures(testbot):
+    plugin = _infrastructure(testbot, minions=5, failure_rate=1)
+    plugin.results_max_length = 150
+    plugin.results_upload = True
+    uploads = _record_uploads(plugin)
+    testbot.push_message('!deploy staging')
+    messages = _pop_until(testbot, 'Finished job')
+    assert 'uploading full results' in '\n'.join(messages)
+    assert [name for name, _ in uploads] == ['failures-reggie-0001.yaml']
+    assert 'Unable to manage file' in uploads[0][1]
+
+
+def test_prometheus(tmpdir):
+    perf = PerfStats()
+    for duration in (0.003, 0.02, 0.02, 7, 400):
+        perf.record('poll', 0, duration)
+    perf.record('send', 0, 0.5)
+
+    path = str(tmpdir.join('magbot.prom'))
+    perf.write_prometheus(path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines[:2] == [
+        '# HELP magbot_salt_phase_seconds Time spent in each phase of salt commands.',
+        '# TYPE magbot_salt_phase_seconds histogram',
+    ]
+    samples = dict(line.rsplit(' ', 1) for line in lines[2:])
+    assert samples['magbot_salt_phase_seconds_bucket{phase="poll",le="0.005"}'] == '1'
+    assert samples['magbot_salt_phase_seconds_bucket{phase="poll",le="0.01"}'] == '1'
+    assert samples['magbot_salt_phase_seconds_bucket{phase="poll",le="0.025"}'] == '3'
+    assert samples['magbot_salt_phase_seconds_bucket{phase="poll",le="10"}'] == '4'
+    assert samples['magbot_salt_phase_seconds_bucket{phase="poll",le="300"}'] == '4'
+    assert samples['magbot_salt_phase_seconds_bucket{phase="poll",le="+Inf"}'] == '5'
+    assert float(samples['magbot_salt_phase_seconds_sum{phase="poll"}']) == pytest.approx(407.043)
+    assert samples['magbot_salt_phase_seconds_count{phase="poll"}'] == '5'
+    assert samples['magbot_salt_phase_seconds_bucket{phase="send",le="0.5"}'] == '1'
+    assert samples['magbot_salt_phase_seconds_count{phase="send"}'] == '1'
+    assert len(samples) == 2 * (len(PerfStats.BUCKETS) + 3)
+
+
+def test_salt_perf(testbot):
+    _infrastructure(testbot, minions=10)
+    testbot.push_message('!ping prod')
+    testbot.pop_message()
+    testbot.push_message('!salt perf')
+    report = testbot.pop_message()
+    assert 'phase' in report
+    assert 'cmd:ping' in report
+    assert 'api:local:test.ping' in report
+
+    testbot.push_message('!deploy staging')
+    _pop_until(testbot, 'Finished job')
+    jid = next(iter(fake_salt.jobs))
+    testbot.push_message('!salt perf {}'.format(jid))
+    timeline = testbot.pop_message()
+    assert 'deploy (jobs: {})'.format(jid) in timeline
+    assert 'api:local_async:state.apply' in timeline
+    testbot.assertCommand('!salt perf 1234', "I don't have a timeline for job 1234")
+
+
+def test_percentile():
+    assert percentile([1, 2, 3, 4, 5], 0.5) == 3
+    assert percentile(list(range(1, 10)), 0.5) == 5
+    assert percentile([1, 2, 3, 4], 0.5) == 2
+    assert percentile(list(range(1, 31)), 0.95) == 29
+    assert percentile([7], 0.95) == 7
+    assert percentile([1, 2, 3], 0) == 1
+    assert percentile([1, 2, 3], 1) == 3
+
+
+def test_job_stats_missing_minions():
+    stats = JobStats()
+    stats.start('1', 'prod', started=100)
+    stats.record_minion('1', 'reggie-0000', {}, returned=110)
+    stats.finish('1', ['reggie-0005'], finished=280)
+    stats.start('2', 'prod', started=300)
+    stats.finish('2', ['reggie-0005'], finished=480)
+    minions, _ = stats.slowest()
+    assert minions == [('reggie-0005', 180.0, 180.0, 2, 2), ('reggie-0000', 10.0, 10.0, 1, 0)]
+
+
+def test_job_state():
+    job = JobState('1', ['reggie-0000', 'reggie-0001', 'reggie-0002'], 'deploy', ['prod'], 'G@env:prod', 'gbin', 9)
+    for minion, started in [('reggie-0000', '12:00:01.5'), ('reggie-0001', '12:00:03.2')]:
+        job.add_returned(minion, [{
+            '__id__': 'reggie_venv',
+            '__sls__': 'reggie.install',
+            '__run_num__': 12,
+            'name': '/srv/reggie/venv',
+            'result': False,
+            'comment': 'Command failed',
+            'changes': {},
+            'start_time': started,
+            'duration': 1000 * len(minion) + len(started),
+        }])
+    job.add_returned('reggie-0003')
+
+    # Identical failures share a signature, whatever their timings
+    assert len(job.failures) == 1
+    resumed = JobState.from_dict(job.to_dict())
+    assert resumed.to_dict() == job.to_dict()
+    assert resumed.failed_minions() == ['reggie-0000', 'reggie-0001']
+    assert resumed.missing_minions() == ['reggie-0002']
+    assert resumed.failed_states('reggie-0001')[0]['comment'] == 'Command failed'
+    assert resumed.is_returned('reggie-0003')
+
+
+def test_resume_deploy(testbot):
+    plugin = _infrastructure(testbot, minions=5, latency=(1, 1.5))
+    manager = testbot.bot.plugin_manager
+    testbot.push_message('!deploy staging')
+    _pop_until(testbot, 'Started job')
+    time.sleep(0.3)
+    manager.deactivate_plugin('Infrastructure')
+    manager.activate_plugin('Infrastructure')
+
+    messages = _pop_until(testbot, 'Finished job')
+    assert 'Resumed job' in messages[0]
+    assert 'reggie-0001' in '\n'.join(messages)
+    assert fake_salt.calls['local_async:state.apply'] == 1
+    assert not plugin.get('salt_jobs')
+
+
+def test_resume_bad_checkpoint(testbot):
+    plugin = _infrastructure(testbot)
+    manager = testbot.bot.plugin_manager
+    plugin['salt_jobs'] = {'1': {'jid': '1'}}
+    manager.deactivate_plugin('Infrastructure')
+    manager.activate_plugin('Infrastructure')
+    assert 'Infrastructure' in manager.get_all_active_plugin_names()
+    assert plugin.get('salt_jobs') == {}
+
+
+def test_resume_in_thread(testbot):
+    plugin = _infrastructure(testbot)
+    manager = testbot.bot.plugin_manager
+    resumed = []
+
+    async def resume_async_cmd(job, msg):
+        resumed.append(msg)
+    plugin._resume_async_cmd = resume_async_cmd
+
+    job = JobState('1', ['reggie-0000'], 'deploy', ['prod'], 'G@env:prod', 'gbin', 9, reply_ts='1535780898.7453')
+    plugin['salt_jobs'] = {'1': job.to_dict()}
+    manager.deactivate_plugin('Infrastructure')
+    manager.activate_plugin('Infrastructure')
+    deadline = time.monotonic() + 5
+    while not resumed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert plugin._message_ts(resumed[0]) == '1535780898.7453'
+
+
+def test_resume_failure_dropped(testbot):
+    plugin = _infrastructure(testbot)
+    manager = testbot.bot.plugin_manager
+    job = JobState('1', ['reggie-0000'], 'no_such_command', ['prod'], 'G@env:prod', 'gbin', 9)
+    plugin['salt_jobs'] = {'1': job.to_dict()}
+    manager.deactivate_plugin('Infrastructure')
+    manager.activate_plugin('Infrastructure')
+    assert 'Salt command failed' in testbot.pop_message()
+    assert plugin.get('salt_jobs') == {}
+    assert not plugin._current_jobs
+
+
+def test_batch_deploy(testbot):
+    plugin = _infrastructure(testbot, minions=20)
+    testbot.push_message('!deploy staging --batch 2')
+    messages = _pop_until(testbot, 'Finished rollout')
+    assert 'Rolling out to 4 servers in 2 waves' in '\n'.join(messages)
+    assert fake_salt.calls['local_async:state.apply'] == 2
+    assert [job.minions for job in fake_salt.jobs.values() if job.fun == 'state.apply'] == [
+        ['reggie-0001', 'reggie-0006'], ['reggie-0011', 'reggie-0016']]
+    # Every wave deploys the same commit
+    assert plugin.repo_syncs == 1
+
+
+def test_batch_deploy_max_fail(testbot):
+    _infrastructure(testbot, minions=20, failure_rate=1)
+    testbot.push_message('!deploy staging --batch 2 --max-fail 1')
+    messages = _pop_until(testbot, 'Stopped rollout')
+    assert 'Stopped rollout after wave 1/2: 2/4 servers, 2 failed' in messages[-1]
+    assert 'Starting wave 2/2' not in '\n'.join(messages)
+    time.sleep(0.5)
+    assert fake_salt.calls['local_async:state.apply'] == 1
+    assert [job.minions for job in fake_salt.jobs.values() if job.fun == 'state.apply'] == [
+        ['reggie-0001', 'reggie-0006']]
+
+
+def test_batch_deploy_uncached_minion(testbot):
+    _infrastructure(testbot, minions=20)
+    # Added since the minion cache was refreshed
+    fake_salt.grains['reggie-0021'] = {'roles': ['reggie'], 'env': 'staging'}
+    testbot.push_message('!deploy staging --batch 2')
+    messages = _pop_until(testbot, 'Finished rollout')
+    assert 'Rolling out to 5 servers in 3 waves' in '\n'.join(messages)
+    assert 'reggie-0021' in list(fake_salt.jobs.values())[-1].minions
+    assert fake_salt.calls['local_async:state.apply'] == 3
+
+
+def test_concurrent_repo_syncs(testbot):
+    plugin = _infrastructure(testbot)
+    syncs = [plugin._salt_loop.submit(plugin._sync_infrastructure_repo()) for _ in range(3)]
+    assert [sync.result(10) for sync in syncs] == ['c0ffee'] * 3
+    assert plugin.repo_syncs == 1
+    assert plugin._salt_loop.submit(plugin._sync_infrastructure_repo()).result(10) == 'c0ffee'
+    assert plugin.repo_syncs == 2
+
+
+def test_no_servers_match(testbot):
+    _infrastructure(testbot, minions=20)
+    testbot.assertCommand('!ping prod west 2019', 'No servers match prod west 2019')
+    assert not fake_salt.calls
+
+
+def test_targets(testbot):
+    plugin = _infrastructure(testbot, minions=20)
+    testbot.push_message('!targets prod roles:Reg.*')
+    reply = testbot.pop_message()
+    assert 'G@roles:reggie and G@env:prod and P@roles:Reg.*' in reply
+    assert 'Matches 4 servers' in reply
+    assert 'reggie-0015' in reply
+    assert not fake_salt.calls
+
+    testbot.assertCommand('!targets prod E@reggie-(', 'without the salt master')
+
+    plugin._minion_cache = None
+    testbot.assertCommand('!targets prod', 'until the minion cache is loaded')
+
+
+def test_targets_offline_minion(testbot):
+    plugin = _infrastructure(testbot, minions=20)
+    fake_salt.offline.add('reggie-0015')
+    plugin._salt_loop.submit(plugin._refresh_minion_cache()).result(10)
+    testbot.push_message('!targets prod west')
+    assert 'reggie-0015' in testbot.pop_message()
+    assert fake_salt.calls['runner:cache.grains'] == 1
+    assert not fake_salt.calls['local:grains.item']
+
+
+def test_reload_mid_repo_sync(testbot):
+    plugin = _infrastructure(testbot, minions=5)
+    manager = testbot.bot.plugin_manager
+    release = threading.Event()
+
+    def update_infrastructure_repo():
+        release.wait(5)
+        return 'c0ffee'
+    plugin._update_infrastructure_repo = update_infrastructure_repo
+    plugin._salt_loop.submit(plugin._sync_infrastructure_repo())
+    deadline = time.monotonic() + 5
+    while plugin._infrastructure_sync is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert plugin._infrastructure_sync is not None
+
+    manager.deactivate_plugin('Infrastructure')
+    manager.activate_plugin('Infrastructure')
+    assert plugin._infrastructure_sync is None
+    release.set()
+    testbot.push_message('!deploy staging')
+    messages = _pop_until(testbot, 'Finished job')
+    assert 'Salt command failed' not in '\n'.join(messages)
+
+
+def test_update_infrastructure_repo(testbot):
+    plugin = _infrastructure(testbot)
+    del plugin._update_infrastructure_repo
+    head = ['c0ffee']
+    commands = []
+
+    class Connection(object):
+        def sudo(self, command, hide=False):
+            commands.append(command)
+            return SimpleNamespace(stdout=head[0] + '\n' if 'rev-parse' in command else '')
+
+    @contextmanager
+    def fabric_connection():
+        yield Connection()
+    plugin.FabricConnection = fabric_connection
+
+    def updates():
+        return commands.count('salt-run fileserver.update')
+
+    assert plugin._update_infrastructure_repo() == 'c0ffee'
+    assert updates() == 1
+    # HEAD unchanged, so the fileserver is already up to date
+    assert plugin._update_infrastructure_repo() == 'c0ffee'
+    assert updates() == 1
+    head[0] = 'decaf'
+    assert plugin._update_infrastructure_repo() == 'decaf'
+    assert updates() == 2
+    assert commands.count('git -C /srv/infrastructure pull') == 3
+
+
+def test_resolve_grains_case_insensitive():
+    cache = MinionCache({'reggie-0000': {'roles': ['Reggie'], 'env': 'prod'}})
+    assert cache.resolve('G@roles:reggie') == {'reggie-0000'}
+    assert cache.resolve('G@roles:REGGIE and G@env:Prod') == {'reggie-0000'}
+    assert cache.resolve('P@roles:Reg.*') == {'reggie-0000'}
+    assert cache.resolve('P@roles:web') == set()
+
+
+def test_fake_salt_match():
+    fake_salt.reset(minions=10)
+    assert fake_salt.match('G@roles:REGGIE and G@env:Prod', 'compound') == ['reggie-0000', 'reggie-0005']
+    assert fake_salt.match('P@roles:Reg.* and not E@reggie-000[0-4]', 'compound') == [
+        'reggie-0005', 'reggie-0006', 'reggie-0007', 'reggie-0008', 'reggie-0009']
+    assert fake_salt.match('G@roles:mcp or ( G@env:dev and G@event_name:labs )', 'compound') == [
+        'mcp.magfest.net', 'reggie-0008']
+    assert fake_salt.match('P@roles:(web', 'compound') == []
+    assert fake_salt.match('reggie-000[12]') == ['reggie-0001', 'reggie-0002']
+    assert fake_salt.match('reggie-0003,mcp.magfest.net,web1', 'list') == ['mcp.magfest.net', 'reggie-0003']
+
+
+def test_resolve_invalid_regex():
+    cache = MinionCache({'reggie-0000': {'roles': ['reggie'], 'env': 'prod'}})
+    assert cache.resolve('P@roles:reg.*') == {'reggie-0000'}
+    assert cache.resolve('P@roles:(web') is None
+    assert cache.resolve('E@reggie-(') is None
+
+
+def test_poll_interval(testbot):
+    plugin = _infrastructure(testbot)
+    _, interval, times = plugin._async_cmd_schedule('update_mcp')
+    assert (interval, times) == (0.05, 20 * 9 / 0.05)
+    plugin.poll_interval = None
+    assert plugin._async_cmd_schedule('update_mcp')[1:] == (20, 9)
+
+
+def _time_cpu(plugin, name, cpu_times):
+    """
+    Wraps a method of plugin to add up the CPU time it uses. Coroutines are
+    timed on the thread they run on, including any other work the event
+    loop does while they wait.
+    """
+    method = getattr(plugin, name)
+    if asyncio.iscoroutinefunction(method):
+        @wraps(method)
+        async def timed(*args, **kwargs):
+            started = _thread_time()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                cpu_times[name] += _thread_time() - started
+    else:
+        @wraps(method)
+        def timed(*args, **kwargs):
+            started = _thread_time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                cpu_times[name] += _thread_time() - started
+    setattr(plugin, name, timed)
+
+
+@pytest.mark.skipif(not os.environ.get('MAGBOT_SALT_BENCHMARK'), reason='set MAGBOT_SALT_BENCHMARK to run')
+def test_benchmark_deploy(testbot, capsys):
+    minions = int(os.environ.get('MAGBOT_SALT_BENCHMARK_MINIONS', 2500))
+    jobs = int(os.environ.get('MAGBOT_SALT_BENCHMARK_JOBS', 3))
+    latency = float(os.environ.get('MAGBOT_SALT_BENCHMARK_LATENCY', 5))
+    failure_rate = float(os.environ.get('MAGBOT_SALT_BENCHMARK_FAILURE_RATE', 0.01))
+
+    plugin = _infrastructure(testbot, minions=minions, latency=(0, latency), failure_rate=failure_rate)
+    plugin.poll_interval = 0.5
+    cpu_times = Counter()
+    for name in ('async_cmd_poller', '_format_results'):
+        _time_cpu(plugin, name, cpu_times)
+
+    elapsed = []
+    calls = Counter()
+    for _ in range(jobs):
+        fake_salt.calls.clear()
+        started = time.monotonic()
+        testbot.push_message('!deploy prod')
+        _pop_until(testbot, 'Finished job', timeout=latency * 10 + 30)
+        elapsed.append(time.monotonic() - started)
+        calls.update(fake_salt.calls)
+
+    targets = len(fake_salt.match('G@roles:reggie and G@env:prod', 'compound'))
+    lines = [
+        'Salt deploy: {} jobs to {} of {} minions, returning within {}s, {:.0%} failing'.format(
+            jobs, targets, minions, latency, failure_rate),
+        '  latency mean   {:>10.2f} s'.format(sum(elapsed) / jobs),
+        '  latency max    {:>10.2f} s'.format(max(elapsed)),
+        '  {:<24} {:>10}'.format('api calls per job', ''),
+    ]
+    for call, count in sorted(calls.items()):
+        lines.append('  {:<24} {:>10.1f}'.format(call, count / jobs))
+    lines.append('  {:<24} {:>10} {:>14}'.format('cpu per job', '', 'per minion'))
+    for name, seconds in sorted(cpu_times.items(), key=lambda i: i[1], reverse=True):
+        lines.append('  {:<24} {:>9.3f}s {:>12.1f}us'.format(name, seconds / jobs, seconds / jobs / targets * 1e6))
+    with capsys.disabled():
+        print('\n' + '\n'.join(lines))
+
+    assert max(elapsed) < latency + plugin.poll_interval * 10
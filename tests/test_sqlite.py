@@ -0,0 +1,31 @@
+from sqlite import SQLiteStorage
+
+from links import LinkTrigger
+
+
+def test_sqlite(tmpdir):
+    store = SQLiteStorage(str(tmpdir.join('test.sqlite')))
+    store.set_many([('alpha', 1), ('Beta', 2), ('betamax', 3), ('gamma', 4)])
+    store.set('link', LinkTrigger('link', ['http://a.com', 'http://b.com']))
+
+    assert store.len() == 5
+    assert store.get('alpha') == 1
+    assert store.get_lower('BETA') == 2
+    assert store.keys() == ['Beta', 'alpha', 'betamax', 'gamma', 'link']
+    assert store.keys_with_prefix('beta') == ['betamax']
+    assert store.keys_with_prefix('') == store.keys()
+    assert store.count_with_prefix('g') == 1
+    assert store.keys_in_range('b', 'h', limit=1, offset=1) == ['gamma']
+    assert store.keys_for_term('url', 'http://b.com') == ['link']
+
+    store.set('link', LinkTrigger('link', ['http://a.com']))
+    assert store.keys_for_term('url', 'http://b.com') == []
+    store.remove('link')
+    assert store.keys_for_term('url', 'http://a.com') == []
+
+    try:
+        store.get('link')
+        assert False
+    except KeyError:
+        pass
+    store.close()